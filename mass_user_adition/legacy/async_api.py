@@ -0,0 +1,389 @@
+#!/usr/bin/env python3
+"""Asyncio API for bulk user creation.
+
+Usage from another service::
+
+    import async_api
+
+    config = async_api.make_config(location_id="...", workers=20)
+    async for result in async_api.create_users_stream(rows, config):
+        ...
+
+``rows`` is any iterable or async iterable of CSV-like dicts (for example a
+``csv.DictReader``). Results have the same shape as
+``create_users.process_row`` and are yielded as soon as each row finishes,
+so they are not necessarily in row order. Set ``config.existing`` to a
+``create_users.ExistingUsers`` index to skip people who already exist.
+"""
+import asyncio
+import ssl
+from types import SimpleNamespace
+from urllib import parse
+
+import create_users as cu
+import metrics
+
+
+def make_config(**overrides):
+    config = SimpleNamespace(
+        base_url=cu.BASE_URL_DEFAULT,
+        api_version=cu.API_VERSION_DEFAULT,
+        user_agent=cu.USER_AGENT_DEFAULT,
+        token=cu.TOKEN_DEFAULT,
+        location_id=None,
+        company_id=None,
+        delay=0.0,
+        timeout=30.0,
+        row_deadline=cu.ROW_DEADLINE_DEFAULT,
+        dry_run=False,
+        workers=10,
+        existing=None,
+    )
+    for key, value in overrides.items():
+        setattr(config, key, value)
+    return config
+
+
+class AsyncTransport:
+    # Minimal HTTP/1.1 client on asyncio streams. Idle keep-alive connections
+    # are reused across requests to the same host.
+
+    def __init__(self, base_url, max_idle=10):
+        parsed = parse.urlsplit(base_url)
+        self.secure = parsed.scheme == "https"
+        self.host = parsed.hostname
+        self.port = parsed.port or (443 if self.secure else 80)
+        # HTTP/1.1 wants the port in Host unless it is the scheme's default.
+        self.host_header = f"[{self.host}]" if ":" in self.host else self.host
+        if self.port != (443 if self.secure else 80):
+            self.host_header += f":{self.port}"
+        self.prefix = parsed.path.rstrip("/")
+        self.max_idle = max_idle
+        self._idle = []
+        self._ssl = ssl.create_default_context() if self.secure else None
+
+    async def _connect(self):
+        while self._idle:
+            reader, writer = self._idle.pop()
+            if not reader.at_eof() and not writer.is_closing():
+                return reader, writer
+            writer.close()
+        return await asyncio.open_connection(
+            self.host,
+            self.port,
+            ssl=self._ssl,
+            server_hostname=self.host if self.secure else None,
+        )
+
+    def _release(self, reader, writer, reusable):
+        if reusable and len(self._idle) < self.max_idle:
+            self._idle.append((reader, writer))
+        else:
+            writer.close()
+
+    async def request(self, method, path, headers, payload=None, timeout=30.0):
+        return await asyncio.wait_for(
+            self._request(method, path, headers, payload), timeout
+        )
+
+    async def _request(self, method, path, headers, payload):
+        reader, writer = await self._connect()
+        try:
+            lines = [
+                f"{method} {self.prefix}{path} HTTP/1.1",
+                f"Host: {self.host_header}",
+            ]
+            for key, value in headers.items():
+                lines.append(f"{key}: {value}")
+            lines.append(f"Content-Length: {len(payload or b'')}")
+            head = ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1")
+            writer.write(head + (payload or b""))
+            await writer.drain()
+
+            status_line = await reader.readline()
+            if not status_line:
+                raise ConnectionResetError("connection closed by server")
+            status = int(status_line.split()[1])
+            response_headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b"\r\n", b"\n", b""):
+                    break
+                key, _, value = line.decode("latin-1").partition(":")
+                response_headers[key.strip().lower()] = value.strip()
+
+            reusable = response_headers.get("connection", "").lower() != "close"
+            if response_headers.get("transfer-encoding", "").lower() == "chunked":
+                raw = await self._read_chunked(reader)
+            elif "content-length" in response_headers:
+                raw = await reader.readexactly(int(response_headers["content-length"]))
+            else:
+                raw = await reader.read()
+                reusable = False
+        except BaseException:
+            writer.close()
+            raise
+
+        self._release(reader, writer, reusable)
+        return status, raw.decode("utf-8"), response_headers
+
+    async def _read_chunked(self, reader):
+        chunks = []
+        while True:
+            size_line = await reader.readline()
+            size = int(size_line.split(b";")[0].strip() or b"0", 16)
+            if size == 0:
+                # Skip trailers up to the terminating blank line.
+                while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                    pass
+                break
+            chunks.append(await reader.readexactly(size))
+            await reader.readline()
+        return b"".join(chunks)
+
+    async def close(self):
+        while self._idle:
+            _, writer = self._idle.pop()
+            writer.close()
+
+
+class _Headers(dict):
+    # Case-insensitive lookups for RateLimiter.observe().
+    def get(self, key, default=None):
+        return super().get(key.lower(), default)
+
+
+async def post_user(
+    transport,
+    config,
+    body,
+    location_id,
+    limiter=None,
+    retry=None,
+    deadline=None,
+    info=None,
+):
+    limiter = limiter or cu.RATE_LIMITER
+    retry = retry or cu.RETRY_POLICY
+    headers = cu.build_request_headers(
+        config.token,
+        config.api_version,
+        config.user_agent,
+        True,
+        {"LocationId": location_id} if location_id else None,
+    )
+    payload = cu.encode_body(body)
+    throttled = 0
+    attempt = 0
+    while True:
+        wait = limiter.reserve()
+        if wait:
+            await asyncio.sleep(wait)
+        try:
+            status, raw, response_headers = await transport.request(
+                "POST",
+                "/users/",
+                headers,
+                payload,
+                cu.remaining_timeout(config.timeout, deadline),
+            )
+        except (OSError, asyncio.TimeoutError) as exc:
+            # The async transport cannot tell whether the request was sent,
+            # so only connection failures are retried for POST.
+            sent = not isinstance(exc, ConnectionRefusedError)
+            wait = retry.delay(attempt, deadline)
+            if wait is None or not retry.retry_error("POST", exc, sent):
+                raise
+        else:
+            limiter.observe(status, _Headers(response_headers))
+            if status == 429 and throttled < cu.RATE_LIMIT_RETRIES:
+                throttled += 1
+                continue
+            wait = None
+            if retry.retry_status("POST", status):
+                wait = retry.delay(attempt, deadline)
+            if wait is None:
+                return status, raw
+
+        attempt += 1
+        if info is not None:
+            info["retries"] = info.get("retries", 0) + 1
+        await asyncio.sleep(wait)
+
+
+async def record_scopes(key, rejected):
+    # The outcome is recorded in memory right away; the file is written in
+    # the default executor so the event loop never blocks on disk.
+    if cu.SCOPE_OUTCOMES.record(key, rejected, persist=False):
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, cu.SCOPE_OUTCOMES.save)
+
+
+async def send_body(transport, config, body, location_id, info=None):
+    deadline = cu.row_deadline(config)
+    scope_key = None
+    if "scopes" in body:
+        scope_key = cu.SCOPE_OUTCOMES.key(body, location_id)
+        if not cu.SCOPE_OUTCOMES.send_scopes(scope_key):
+            metrics.SCOPE_RETRIES.inc("learned")
+            body = cu.strip_scopes(body)
+
+    status, response_body = await post_user(
+        transport, config, body, location_id, deadline=deadline, info=info
+    )
+    if scope_key is not None and "scopes" in body and status in (200, 201):
+        await record_scopes(scope_key, False)
+    if cu.should_retry_without_scopes(status, body, response_body):
+        metrics.SCOPE_RETRIES.inc("rejected")
+        await record_scopes(scope_key, True)
+        body_no_scopes = cu.strip_scopes(body)
+        status, response_body = await post_user(
+            transport,
+            config,
+            body_no_scopes,
+            location_id,
+            deadline=deadline,
+            info=info,
+        )
+    return status, response_body
+
+
+async def claim_settled(existing, index, email, phone):
+    # ExistingUsers.claim_settled() without blocking the event loop.
+    loop = asyncio.get_running_loop()
+    while True:
+        match = existing.claim(index, email, phone)
+        if match is None or not match.get("pending"):
+            return match
+        settled = loop.create_future()
+        existing.when_settled(
+            match["row"],
+            lambda future=settled: loop.call_soon_threadsafe(_resolve, future),
+        )
+        await settled
+
+
+def _resolve(future):
+    if not future.done():
+        future.set_result(None)
+
+
+async def process_row(
+    transport, index, row, mapping, config, normalized=None, created=None
+):
+    # created, when given, collects the locations that got a new user.
+    error_result, role, body, location_id = cu.prepare_row(
+        index, row, mapping, config, normalized
+    )
+    if error_result:
+        return error_result
+
+    existing = getattr(config, "existing", None)
+    if existing is None:
+        result = await post_row(transport, index, role, body, location_id, config)
+        if created is not None and result["status"] == "created":
+            created.add(location_id)
+        return result
+    match = await claim_settled(existing, index, body["email"], body["phone"])
+    if match is not None:
+        return cu.existing_result(index, match)
+    result = None
+    try:
+        result = await post_row(transport, index, role, body, location_id, config)
+    finally:
+        existing.settle(index, result)
+    if created is not None and result["status"] == "created":
+        created.add(location_id)
+    return result
+
+
+async def post_row(transport, index, role, body, location_id, config):
+    if config.dry_run:
+        return {"row": index, "status": "dry-run", "role": role, "body": body}
+
+    info = {"retries": 0}
+    loop = asyncio.get_running_loop()
+    started = loop.time()
+    try:
+        status, response_body = await send_body(
+            transport, config, body, location_id, info
+        )
+    except (OSError, asyncio.TimeoutError) as exc:
+        result = cu.network_failure(index, exc, info["retries"])
+    else:
+        result = cu.post_result(index, status, response_body, info["retries"])
+    result["elapsed"] = round(loop.time() - started, 4)
+
+    if config.delay:
+        await asyncio.sleep(config.delay)
+    return result
+
+
+async def _enumerate(rows, start):
+    index = start
+    if hasattr(rows, "__aiter__"):
+        async for row in rows:
+            yield index, row
+            index += 1
+    else:
+        for row in rows:
+            yield index, row
+            index += 1
+
+
+async def create_users_stream(rows, config, mapping=None, start=2):
+    # Keeps up to config.workers rows in flight on the running event loop.
+    # Breaking out of the loop cancels the rows still in flight. Disk work
+    # (loading scope outcomes, dropping cached listings of the locations that
+    # got new users) runs in the default executor, once per stream.
+    concurrency = max(1, getattr(config, "workers", 1) or 1)
+    transport = AsyncTransport(config.base_url, max_idle=concurrency)
+    loop = asyncio.get_running_loop()
+    in_flight = set()
+    created = set()
+    normalize = None
+    await loop.run_in_executor(None, cu.SCOPE_OUTCOMES.load)
+    try:
+        async for index, row in _enumerate(rows, start):
+            if mapping is None:
+                mapping = cu.resolve_headers(list(row.keys()))
+                if not mapping:
+                    raise ValueError("No recognized headers found in rows.")
+            if normalize is None:
+                normalize = cu.make_normalizer(mapping)
+            in_flight.add(
+                asyncio.ensure_future(
+                    process_row(
+                        transport,
+                        index,
+                        row,
+                        mapping,
+                        config,
+                        normalize(row),
+                        created,
+                    )
+                )
+            )
+            if len(in_flight) >= concurrency:
+                done, in_flight = await asyncio.wait(
+                    in_flight, return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in done:
+                    yield task.result()
+        while in_flight:
+            done, in_flight = await asyncio.wait(
+                in_flight, return_when=asyncio.FIRST_COMPLETED
+            )
+            for task in done:
+                yield task.result()
+    finally:
+        for task in in_flight:
+            task.cancel()
+        await transport.close()
+        if created:
+            await loop.run_in_executor(None, _invalidate_users, created)
+
+
+def _invalidate_users(location_ids):
+    for location_id in location_ids:
+        cu.USERS_CACHE.invalidate(location_id)
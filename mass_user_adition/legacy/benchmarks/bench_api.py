@@ -0,0 +1,379 @@
+#!/usr/bin/env python3
+"""End-to-end benchmarks against the local GHL stand-in (mock_ghl.py).
+
+For every mock scenario and CSV size it times a CLI import (create_users.py
+--csv), a streamed /run on server.py and repeated /list calls, and reports
+rows per second with p50/p95/p99 latency. Row latency comes from the
+"elapsed" field the import records per row (journal for the CLI, NDJSON rows
+for /run); /list latency is per request. Results are saved under
+benchmarks/results/ and compared with the previous saved run.
+
+    python3 benchmarks/bench_api.py --sizes 100,1000 --workers 10
+    python3 benchmarks/bench_api.py --targets cli --scenarios clean,burst429
+"""
+import argparse
+import csv
+import json
+import platform
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from urllib import request
+
+BENCH_DIR = Path(__file__).resolve().parent
+LEGACY_DIR = BENCH_DIR.parent
+RESULTS_DIR = BENCH_DIR / "results"
+
+sys.path.insert(0, str(BENCH_DIR))
+
+import mock_ghl  # noqa: E402
+
+LOCATION_ID = "bench"
+TARGETS = ("cli", "run", "list")
+SCENARIOS = {
+    "clean": {},
+    "errors": {"error_rate": 0.05, "reject_rate": 0.02},
+    "burst429": {"burst_every": 100, "burst_size": 5},
+    "scopes": {"reject_scopes": True},
+}
+ROLES = ("Vendedor", "Administrador")
+
+
+def percentile(values, fraction):
+    # Nearest-rank percentile; None for an empty sample.
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(1, round(fraction * len(ordered) + 0.5))
+    return ordered[min(rank, len(ordered)) - 1]
+
+
+def summarize(target, scenario, size, items, seconds, latencies, failed):
+    return {
+        "target": target,
+        "scenario": scenario,
+        "size": size,
+        "items": items,
+        "seconds": round(seconds, 3),
+        "perSecond": round(items / seconds, 1) if seconds else None,
+        "p50": percentile(latencies, 0.50),
+        "p95": percentile(latencies, 0.95),
+        "p99": percentile(latencies, 0.99),
+        "failed": failed,
+    }
+
+
+def write_csv(path, size):
+    with open(path, "w", encoding="utf-8", newline="") as handle:
+        writer = csv.writer(handle)
+        writer.writerow(["USUARIO", "FONE", "EMAIL", "PERFIL"])
+        for index in range(size):
+            writer.writerow(
+                [
+                    f"bench user {index}",
+                    f"(11) 9{index:08d}",
+                    f"bench{index}@example.com",
+                    ROLES[index % len(ROLES)],
+                ]
+            )
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_server(workdir):
+    port = free_port()
+    process = subprocess.Popen(
+        [
+            sys.executable,
+            str(LEGACY_DIR / "server.py"),
+            "--port",
+            str(port),
+            "--max-rps",
+            "0",
+            "--jobs-dir",
+            str(workdir / "jobs"),
+            "--scope-outcomes",
+            str(workdir / "server_scopes.json"),
+        ],
+        cwd=workdir,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    url = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline:
+        try:
+            request.urlopen(url + "/", timeout=1).close()
+            return process, url
+        except OSError:
+            time.sleep(0.05)
+    process.kill()
+    raise RuntimeError("server.py did not start")
+
+
+def stop_server(process):
+    process.terminate()
+    try:
+        process.wait(timeout=5)
+    except subprocess.TimeoutExpired:
+        process.kill()
+
+
+def bench_cli(base_url, csv_path, args, workdir):
+    journal = workdir / f"journal-{time.time_ns()}.ndjson"
+    command = [
+        sys.executable,
+        str(LEGACY_DIR / "create_users.py"),
+        "--csv",
+        str(csv_path),
+        "--base-url",
+        base_url,
+        "--location-id",
+        LOCATION_ID,
+        "--workers",
+        str(args.workers),
+        "--max-rps",
+        str(args.max_rps),
+        "--journal",
+        str(journal),
+        "--scope-outcomes",
+        str(workdir / f"scopes-{time.time_ns()}.json"),
+    ]
+    started = time.perf_counter()
+    completed = subprocess.run(command, cwd=workdir, capture_output=True, text=True)
+    seconds = time.perf_counter() - started
+    if completed.returncode not in (0, 1):
+        raise RuntimeError(f"create_users.py failed:\n{completed.stdout}")
+
+    latencies = []
+    failed = 0
+    with open(journal, "r", encoding="utf-8") as handle:
+        for line in handle:
+            entry = json.loads(line)
+            latencies.append(entry.get("elapsed", 0.0))
+            failed += entry["status"] != "created"
+    return seconds, latencies, failed
+
+
+def bench_run(base_url, csv_path, args, workdir):
+    # A fresh server per run so learned scope rejections do not carry over.
+    process, server_url = start_server(workdir)
+    try:
+        payload = {
+            "csv": Path(csv_path).read_text(encoding="utf-8"),
+            "baseUrl": base_url,
+            "locationId": LOCATION_ID,
+            "workers": args.workers,
+            "stream": "ndjson",
+        }
+        req = request.Request(
+            server_url + "/run",
+            data=json.dumps(payload).encode("utf-8"),
+            headers={"Content-Type": "application/json"},
+        )
+        latencies = []
+        failed = 0
+        started = time.perf_counter()
+        with request.urlopen(req, timeout=600) as response:
+            for line in response:
+                event = json.loads(line)
+                if event["type"] != "row":
+                    continue
+                if "elapsed" in event:
+                    latencies.append(event["elapsed"])
+                failed += event["status"] != "created"
+        seconds = time.perf_counter() - started
+    finally:
+        stop_server(process)
+    return seconds, latencies, failed
+
+
+def bench_list(base_url, size, args, workdir):
+    # Repeated uncached /list calls for a location with `size` users.
+    process, server_url = start_server(workdir)
+    try:
+        payload = json.dumps(
+            {
+                "baseUrl": base_url,
+                "locationId": f"{LOCATION_ID}-{size}",
+                "cacheTtl": 0,
+                "saveFiles": False,
+            }
+        ).encode("utf-8")
+        latencies = []
+        failed = 0
+        started = time.perf_counter()
+        for _ in range(args.list_requests):
+            req = request.Request(
+                server_url + "/list",
+                data=payload,
+                headers={"Content-Type": "application/json"},
+            )
+            call_started = time.perf_counter()
+            try:
+                with request.urlopen(req, timeout=120) as response:
+                    json.load(response)
+            except OSError:
+                failed += 1
+            latencies.append(round(time.perf_counter() - call_started, 4))
+        seconds = time.perf_counter() - started
+    finally:
+        stop_server(process)
+    return seconds, latencies, failed
+
+
+def run_target(target, scenario, base_url, size, args, workdir):
+    csv_path = workdir / f"rows-{size}.csv"
+    if target == "cli":
+        seconds, latencies, failed = bench_cli(base_url, csv_path, args, workdir)
+    elif target == "run":
+        seconds, latencies, failed = bench_run(base_url, csv_path, args, workdir)
+    else:
+        seconds, latencies, failed = bench_list(base_url, size, args, workdir)
+    items = size * args.list_requests if target == "list" else size
+    return summarize(target, scenario, size, items, seconds, latencies, failed)
+
+
+def previous_results():
+    files = sorted(RESULTS_DIR.glob("bench-*.json"))
+    if not files:
+        return None, {}
+    with open(files[-1], "r", encoding="utf-8") as handle:
+        saved = json.load(handle)
+    indexed = {
+        (item["target"], item["scenario"], item["size"]): item
+        for item in saved.get("results", [])
+    }
+    return files[-1].name, indexed
+
+
+def fmt_ms(value):
+    return f"{value * 1000:8.1f}" if value is not None else f"{'-':>8}"
+
+
+def print_results(results, previous):
+    print(
+        f"{'target':<6} {'scenario':<9} {'size':>6} {'per s':>9} "
+        f"{'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'failed':>6}  change"
+    )
+    for item in results:
+        key = (item["target"], item["scenario"], item["size"])
+        change = ""
+        before = previous.get(key, {}).get("perSecond")
+        if before and item["perSecond"]:
+            change = f"{(item['perSecond'] - before) / before * 100:+.1f}%"
+        print(
+            f"{item['target']:<6} {item['scenario']:<9} {item['size']:>6} "
+            f"{item['perSecond'] or 0:>9.1f} {fmt_ms(item['p50'])} "
+            f"{fmt_ms(item['p95'])} {fmt_ms(item['p99'])} {item['failed']:>6}  "
+            f"{change}"
+        )
+
+
+def save_results(results, args):
+    RESULTS_DIR.mkdir(parents=True, exist_ok=True)
+    path = RESULTS_DIR / time.strftime("bench-%Y%m%d-%H%M%S.json")
+    payload = {
+        "createdAt": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "workers": args.workers,
+        "latency": args.latency,
+        "results": results,
+    }
+    with open(path, "w", encoding="utf-8") as handle:
+        json.dump(payload, handle, indent=2)
+    return path
+
+
+def parse_list(value, allowed=None):
+    items = [item.strip() for item in value.split(",") if item.strip()]
+    if allowed is not None:
+        unknown = [item for item in items if item not in allowed]
+        if unknown:
+            raise argparse.ArgumentTypeError(f"unknown: {', '.join(unknown)}")
+    return items
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark imports and listings.")
+    parser.add_argument(
+        "--sizes",
+        type=lambda value: [int(item) for item in parse_list(value)],
+        default=[100, 1000],
+        help="CSV sizes (rows), and users per /list listing",
+    )
+    parser.add_argument(
+        "--targets",
+        type=lambda value: parse_list(value, TARGETS),
+        default=list(TARGETS),
+        help="Comma-separated subset of cli,run,list",
+    )
+    parser.add_argument(
+        "--scenarios",
+        type=lambda value: parse_list(value, SCENARIOS),
+        default=list(SCENARIOS),
+        help=f"Comma-separated subset of {','.join(SCENARIOS)}",
+    )
+    parser.add_argument("--workers", type=int, default=10)
+    parser.add_argument(
+        "--max-rps",
+        type=float,
+        default=0,
+        help="--max-rps for the CLI runs (default 0: no ceiling)",
+    )
+    parser.add_argument(
+        "--latency", type=float, default=0.02, help="Mock latency in seconds"
+    )
+    parser.add_argument("--list-requests", type=int, default=20)
+    parser.add_argument(
+        "--no-save", action="store_true", help="Do not write benchmarks/results/"
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    label, previous = previous_results()
+    results = []
+    with tempfile.TemporaryDirectory(prefix="bench-api-") as tmp:
+        workdir = Path(tmp)
+        for size in args.sizes:
+            write_csv(workdir / f"rows-{size}.csv", size)
+
+        for scenario in args.scenarios:
+            config = mock_ghl.make_config(latency=args.latency, **SCENARIOS[scenario])
+            mock, base_url = mock_ghl.start(config)
+            try:
+                for size in args.sizes:
+                    for target in args.targets:
+                        item = run_target(
+                            target, scenario, base_url, size, args, workdir
+                        )
+                        results.append(item)
+                        print(
+                            f"{target} {scenario} {size}: "
+                            f"{item['perSecond']} per s in {item['seconds']}s"
+                        )
+            finally:
+                mock.shutdown()
+                mock.server_close()
+
+    print()
+    if label:
+        print(f"Change is rows (or listed users) per second against {label}.")
+    print_results(results, previous)
+    if not args.no_save:
+        print(f"Saved to {save_results(results, args)}")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+"""Micro-benchmark for row normalization.
+
+Generates a synthetic HR export, checks that normalize_rows() gives exactly
+the output of the original per-row functions, and reports rows per second.
+
+    python3 benchmarks/bench_normalize.py --rows 200000
+"""
+import argparse
+import random
+import re
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import create_users as cu  # noqa: E402
+
+FIRST_NAMES = ["ana", "CARLOS", "João", "maria", "PEDRO", "luíza", "José", "bruna"]
+LAST_NAMES = [
+    "silva",
+    "SOUZA",
+    "de oliveira",
+    "santos",
+    "PEREIRA LIMA",
+    "d'ávila",
+    "costa-neto",
+    "",
+]
+ROLES = ["VENDEDOR", "Vendedor", "master", "ADMIN", "sales", "gerente", ""]
+HEADERS = ["USUARIO", "Primeiro Nome", "Sobrenome", "EMAIL", "FONE", "PERFIL"]
+
+
+# Original per-row implementation, kept here as the reference output.
+def reference_canonicalize(value):
+    return re.sub(r"[^a-z0-9]+", "", value.strip().lower())
+
+
+def reference_title_case(value):
+    def repl(match):
+        word = match.group(0)
+        return word[:1].upper() + word[1:].lower()
+
+    return re.sub(r"[^\W\d_]+", repl, value, flags=re.UNICODE)
+
+
+def reference_split_name(full_name):
+    parts = re.findall(r"\S+", full_name or "")
+    if not parts:
+        return "", ""
+    if len(parts) == 1:
+        return parts[0], ""
+    return parts[0], " ".join(parts[1:])
+
+
+def reference_normalize_row(row, mapping):
+    normalized = {
+        key: (row.get(raw_name) or "").strip() for raw_name, key in mapping.items()
+    }
+    if not normalized.get("name"):
+        first = normalized.get("firstName", "")
+        last = normalized.get("lastName", "")
+        combined = f"{first} {last}".strip()
+        if combined:
+            normalized["name"] = combined
+    if normalized.get("name") and (
+        not normalized.get("firstName") or not normalized.get("lastName")
+    ):
+        first, last = reference_split_name(normalized["name"])
+        if not normalized.get("firstName") and first:
+            normalized["firstName"] = first
+        if not normalized.get("lastName") and last:
+            normalized["lastName"] = last
+    if not normalized.get("lastName"):
+        normalized["lastName"] = cu.DEFAULT_LAST_NAME
+    for key in ("name", "firstName", "lastName"):
+        if normalized.get(key):
+            normalized[key] = reference_title_case(normalized[key])
+    return normalized
+
+
+def reference_normalize_role(role_raw):
+    if not role_raw:
+        return ""
+    return cu.ROLE_ALIASES.get(reference_canonicalize(role_raw), "")
+
+
+def make_rows(count, seed):
+    rng = random.Random(seed)
+    rows = []
+    for index in range(count):
+        first = rng.choice(FIRST_NAMES)
+        last = rng.choice(LAST_NAMES)
+        full = f"  {first} {last} " if rng.random() < 0.5 else ""
+        rows.append(
+            {
+                "USUARIO": full,
+                "Primeiro Nome": "" if full else first,
+                "Sobrenome": "" if full else last,
+                "EMAIL": f"user{index}@example.com",
+                "FONE": f"(11) 9{index % 10000:04d}-{index % 7777:04d}",
+                "PERFIL": rng.choice(ROLES),
+            }
+        )
+    return rows
+
+
+def timed(label, count, func):
+    start = time.perf_counter()
+    result = func()
+    elapsed = time.perf_counter() - start
+    print(f"{label:<28} {elapsed:8.3f}s  {count / elapsed:12,.0f} rows/s")
+    return result
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark row normalization.")
+    parser.add_argument("--rows", type=int, default=100000)
+    parser.add_argument("--seed", type=int, default=1)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    rows = make_rows(args.rows, args.seed)
+    mapping = cu.resolve_headers(HEADERS)
+
+    expected = timed(
+        "reference (per row)",
+        args.rows,
+        lambda: [
+            (
+                reference_normalize_row(row, mapping),
+                reference_normalize_role(row["PERFIL"]),
+            )
+            for row in rows
+        ],
+    )
+    per_row = timed(
+        "normalize_row",
+        args.rows,
+        lambda: [
+            (cu.normalize_row(row, mapping), cu.normalize_role(row["PERFIL"]))
+            for row in rows
+        ],
+    )
+    batch = timed(
+        "normalize_rows (batch)",
+        args.rows,
+        lambda: list(
+            zip(
+                cu.normalize_rows(rows, mapping),
+                [cu.normalize_role(row["PERFIL"]) for row in rows],
+            )
+        ),
+    )
+
+    if per_row != expected or batch != expected:
+        print("Output differs from the reference implementation.")
+        return 1
+    print("Output matches the reference implementation.")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
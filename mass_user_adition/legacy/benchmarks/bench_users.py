@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+"""Memory benchmark for listed users.
+
+Builds a synthetic GET /users/ payload shaped like a real agency listing
+(permissions and scopes from the role templates), then compares the memory
+held by the raw decoded dicts with the UserRecords that loads_users() builds
+while parsing, and checks that the JSON and CSV exports of both are
+byte-identical.
+
+    python3 benchmarks/bench_users.py --users 50000
+"""
+import argparse
+import gc
+import json
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import create_users as cu  # noqa: E402
+
+
+def make_payload(count, locations):
+    templates = [cu.read_template(path) for path in cu.TEMPLATE_PATHS.values()]
+    users = []
+    for index in range(count):
+        template = templates[index % len(templates)]
+        roles = template.get("roles", {})
+        location_id = f"location{index % locations}"
+        users.append(
+            {
+                "id": f"user{index:07d}",
+                "name": f"Bench User {index}",
+                "firstName": "Bench",
+                "lastName": f"User {index}",
+                "email": f"bench{index}@example.com",
+                "phone": f"+55119{index:08d}",
+                "extension": "",
+                "permissions": template.get("permissions", {}),
+                "scopes": template.get("scopes") or [],
+                "roles": {
+                    "type": roles.get("type", "account"),
+                    "role": roles.get("role", "user"),
+                    "locationIds": [location_id],
+                    "restrictSubAccount": False,
+                },
+                "deleted": False,
+                "scopesAssignedToOnly": [],
+                "lcPhone": {location_id: f"+55119{index:08d}"},
+                "dateUpdated": "2024-01-01T00:00:00.000Z",
+            }
+        )
+    return json.dumps({"users": users, "count": count})
+
+
+def retained(label, func):
+    # Memory still allocated by func's result once it returns.
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = func()
+    elapsed = time.perf_counter() - start
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(
+        f"{label:<24} {current / 1e6:8.1f} MB held  {peak / 1e6:8.1f} MB peak  "
+        f"{elapsed:6.2f}s"
+    )
+    return result
+
+
+def export(directory, name, users):
+    json_path = Path(directory) / f"{name}.json"
+    csv_path = Path(directory) / f"{name}.csv"
+    cu.write_users_json(json_path, users, "bench")
+    cu.write_users_csv(csv_path, users)
+    return json_path.read_bytes(), csv_path.read_bytes()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark listed users memory.")
+    parser.add_argument("--users", type=int, default=50000)
+    parser.add_argument("--locations", type=int, default=1)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    raw = make_payload(args.users, max(1, args.locations))
+    dicts = retained("raw dicts", lambda: json.loads(raw)["users"])
+    records = retained(
+        "UserRecord (decode)", lambda: cu.decode_users(cu.loads_users(raw)["users"])
+    )
+
+    with tempfile.TemporaryDirectory(prefix="bench-users-") as tmp:
+        if export(tmp, "dicts", dicts) != export(tmp, "records", records):
+            print("Exports differ between raw dicts and UserRecords.")
+            return 1
+    print("JSON and CSV exports are identical.")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,263 @@
+#!/usr/bin/env python3
+"""Local stand-in for the GHL users API, used by the benchmarks.
+
+Serves POST /users/ and GET /users/?locationId=... with configurable latency,
+error rates, 429 bursts and scope rejections. Listings are synthetic: a
+location ID ending in "-<n>" (for example "bench-5000") lists n users, any
+other location lists --users. GET /stats returns the request counters.
+
+    python3 benchmarks/mock_ghl.py --port 9911 --latency 0.02 --error-rate 0.05
+"""
+import argparse
+import json
+import random
+import re
+import socket
+import threading
+import time
+from functools import lru_cache
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+from urllib import parse
+
+USERS_DEFAULT = 100
+_SIZE_RE = re.compile(r"-(\d+)$")
+
+
+def make_config(**overrides):
+    config = SimpleNamespace(
+        latency=0.02,
+        jitter=0.0,
+        error_rate=0.0,
+        reject_rate=0.0,
+        burst_every=0,
+        burst_size=0,
+        retry_after=0.2,
+        reject_scopes=False,
+        users=USERS_DEFAULT,
+        seed=1,
+    )
+    for key, value in overrides.items():
+        setattr(config, key, value)
+    return config
+
+
+@lru_cache(maxsize=32)
+def listing(location_id, count):
+    users = [
+        {
+            "id": f"user{index:07d}",
+            "name": f"Bench User {index}",
+            "firstName": "Bench",
+            "lastName": f"User {index}",
+            "email": f"bench{index}@example.com",
+            "phone": f"+55119{index:08d}",
+            "deleted": False,
+            "roles": {
+                "type": "account",
+                "role": "user",
+                "locationIds": [location_id],
+            },
+            "dateUpdated": "2024-01-01T00:00:00.000Z",
+        }
+        for index in range(count)
+    ]
+    return json.dumps({"users": users, "count": count}).encode("utf-8")
+
+
+class MockState:
+    def __init__(self, config):
+        self.config = config
+        self.lock = threading.Lock()
+        self.rng = random.Random(config.seed)
+        self.requests = 0
+        self.statuses = {}
+
+    def next_request(self):
+        # Returns (request number, random roll) for the error decisions.
+        with self.lock:
+            self.requests += 1
+            return self.requests, self.rng.random()
+
+    def count(self, status):
+        with self.lock:
+            self.statuses[status] = self.statuses.get(status, 0) + 1
+
+    def stats(self):
+        with self.lock:
+            return {"requests": self.requests, "statuses": dict(self.statuses)}
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        super().setup()
+        # Headers and body are separate writes; without TCP_NODELAY the body
+        # waits for the client's delayed ACK and adds ~40ms to responses.
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_body(self, status, data, headers=None):
+        self.server.state.count(status)
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_json(self, status, payload, headers=None):
+        self.send_body(status, json.dumps(payload).encode("utf-8"), headers)
+
+    def inject(self):
+        # Latency, 429 bursts and transient 503s shared by GET and POST.
+        # Returns None when a failure was sent, else the request's random roll.
+        config = self.server.state.config
+        number, roll = self.server.state.next_request()
+        delay = config.latency
+        if config.jitter:
+            delay += random.uniform(0, config.jitter)
+        if delay:
+            time.sleep(delay)
+
+        if config.burst_every and number % config.burst_every < config.burst_size:
+            self.send_json(
+                429,
+                {"message": "Too many requests"},
+                {"Retry-After": str(config.retry_after)},
+            )
+            return None
+        if roll < config.error_rate:
+            self.send_json(503, {"message": "Service unavailable"})
+            return None
+        return roll
+
+    def do_GET(self):
+        url = parse.urlsplit(self.path)
+        if url.path == "/stats":
+            self.send_json(200, self.server.state.stats())
+            return
+        if url.path.rstrip("/") != "/users":
+            self.send_json(404, {"message": "Not found"})
+            return
+        if self.inject() is None:
+            return
+
+        location_id = parse.parse_qs(url.query).get("locationId", [""])[0]
+        match = _SIZE_RE.search(location_id)
+        count = int(match.group(1)) if match else self.server.state.config.users
+        etag = f'"{location_id}-{count}"'
+        if self.headers.get("If-None-Match") == etag:
+            self.send_body(304, b"", {"ETag": etag})
+            return
+        self.send_body(200, listing(location_id, count), {"ETag": etag})
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        raw = self.rfile.read(length)
+        if parse.urlsplit(self.path).path.rstrip("/") != "/users":
+            self.send_json(404, {"message": "Not found"})
+            return
+        roll = self.inject()
+        if roll is None:
+            return
+
+        config = self.server.state.config
+        try:
+            body = json.loads(raw)
+        except ValueError:
+            self.send_json(400, {"message": "Invalid JSON"})
+            return
+        if roll < config.error_rate + config.reject_rate:
+            self.send_json(400, {"message": "email is invalid"})
+            return
+        if config.reject_scopes and "scopes" in body:
+            self.send_json(
+                422, {"message": ["each value in scopes must be one of enum"]}
+            )
+            return
+        self.send_json(201, {"user": {"id": f"new{self.server.state.requests}"}})
+
+
+class MockServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+
+def start(config, host="127.0.0.1", port=0):
+    # Serves in a background thread; returns the server (stop it with
+    # shutdown()) and its base URL.
+    server = MockServer((host, port), Handler)
+    server.state = MockState(config)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://{host}:{server.server_address[1]}"
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Mock GHL users API.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9911)
+    parser.add_argument(
+        "--latency", type=float, default=0.02, help="Seconds per response"
+    )
+    parser.add_argument(
+        "--jitter", type=float, default=0.0, help="Extra random latency (max)"
+    )
+    parser.add_argument(
+        "--error-rate", type=float, default=0.0, help="Fraction of 503 responses"
+    )
+    parser.add_argument(
+        "--reject-rate",
+        type=float,
+        default=0.0,
+        help="Fraction of POSTs rejected with 400",
+    )
+    parser.add_argument(
+        "--burst-every",
+        type=int,
+        default=0,
+        help="Start a burst of 429 responses every N requests",
+    )
+    parser.add_argument(
+        "--burst-size", type=int, default=0, help="429 responses per burst"
+    )
+    parser.add_argument(
+        "--retry-after", type=float, default=0.2, help="Retry-After for 429s"
+    )
+    parser.add_argument(
+        "--reject-scopes",
+        action="store_true",
+        help="Answer 422 to any POST whose body has scopes",
+    )
+    parser.add_argument(
+        "--users", type=int, default=USERS_DEFAULT, help="Users per listing"
+    )
+    parser.add_argument("--seed", type=int, default=1)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    config = make_config(
+        **{
+            key: value
+            for key, value in vars(args).items()
+            if key not in ("host", "port")
+        }
+    )
+    server = MockServer((args.host, args.port), Handler)
+    server.state = MockState(config)
+    print(f"Mock GHL API running at http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
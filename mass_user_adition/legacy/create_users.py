@@ -1,12 +1,30 @@
 #!/usr/bin/env python3
 import argparse
+import base64
 import csv
+import email.utils
+import gzip
+import hashlib
+import http.client
 import json
 import os
+import random
 import re
+import select
+import socket
+import sys
+import threading
 import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+from functools import lru_cache
 from pathlib import Path
-from urllib import error, parse, request
+import urllib.request
+from urllib import parse
+
+import metrics
+import profiling
 
 BASE_URL_DEFAULT = "https://services.leadconnectorhq.com"
 API_VERSION_DEFAULT = "2021-07-28"
@@ -59,13 +77,82 @@ TEMPLATE_PATHS = {
     "vendedor": TEMPLATE_DIR / "vendedor.json",
     "administrador": TEMPLATE_DIR / "administrador.json",
 }
+# Seconds between mtime checks of a cached template.
+TEMPLATE_CHECK_INTERVAL = 1.0
+
+MAX_RPS_DEFAULT = 10.0
+RATE_LIMIT_RETRIES = 5
+RETRIES_DEFAULT = 3
+RETRY_BACKOFF_DEFAULT = 0.5
+RETRY_BACKOFF_MAX = 10.0
+ROW_DEADLINE_DEFAULT = 120.0
+POOL_SIZE_DEFAULT = 10
+POOL_IDLE_TIMEOUT_DEFAULT = 30.0
+LOCATION_WORKERS_DEFAULT = 4
+
+# Country code stripped from phone numbers before de-duplication, so
+# "+55 13 99712-1427" and "(13) 99712-1427" match.
+DEFAULT_COUNTRY_CODE = "55"
+MIN_PHONE_KEY_LENGTH = 8
+
+USERS_CACHE_DIR = Path(__file__).resolve().parent / ".cache" / "users"
+USERS_CACHE_TTL_DEFAULT = 60.0
+
+# Learned "scopes rejected" outcomes per template and location. A rejected
+# template is still sent with scopes once every SCOPE_PROBE_ROWS rows or
+# SCOPE_PROBE_INTERVAL seconds, in case the API starts accepting them.
+SCOPE_OUTCOMES_PATH = Path(__file__).resolve().parent / ".cache" / "scope_outcomes.json"
+SCOPE_PROBE_ROWS = 200
+SCOPE_PROBE_INTERVAL = 3600.0
+
+JOURNAL_PATH_DEFAULT = Path(__file__).resolve().parent / ".cache" / "journal.ndjson"
+JOURNAL_FLUSH_ROWS = 200
+JOURNAL_FLUSH_INTERVAL = 2.0
 
 DEFAULT_USERS_JSON = "users_existing.json"
 DEFAULT_USERS_CSV = "users_existing.csv"
+DEFAULT_USERS_NDJSON = "users_existing.ndjson"
+DEFAULT_USERS_DIFF = "users_diff.json"
+DEFAULT_LOCATIONS_SUMMARY = "users_locations.json"
+USERS_FORMATS = ("json", "compact", "ndjson")
+USERS_CSV_FIELDS = (
+    "id",
+    "name",
+    "firstName",
+    "lastName",
+    "email",
+    "phone",
+    "role",
+    "type",
+    "locationIds",
+    "deleted",
+    "dateAdded",
+    "dateUpdated",
+)
+
+DEFAULT_DRY_RUN_REPORT = "dry_run_report.ndjson"
+DEFAULT_DRY_RUN_SUMMARY = "dry_run_summary.json"
+DRY_RUN_FORMATS = ("ndjson", "summary")
+DRY_RUN_BUFFER_SIZE = 1024 * 1024
+DRY_RUN_SAMPLE_ROWS = 5
+# Seconds between redraws of the dry-run progress line.
+DRY_RUN_PROGRESS_INTERVAL = 0.2
+
 
+_NON_ALNUM_RE = re.compile(r"[^a-z0-9]+")
+_NAME_PART_RE = re.compile(r"\S+")
+_WORD_RE = re.compile(r"[^\W\d_]+", re.UNICODE)
+_NON_DIGIT_RE = re.compile(r"\D+")
 
+# Sizes for the memoized helpers; roles and common first/last names repeat a
+# lot in large exports, while full names rarely do.
+CANONICAL_CACHE_SIZE = 4096
+TITLE_CASE_CACHE_SIZE = 65536
+
+
+@lru_cache(maxsize=CANONICAL_CACHE_SIZE)
 def canonicalize(value: str) -> str:
-    return re.sub(r"[^a-z0-9]+", "", value.strip().lower())
+    return _NON_ALNUM_RE.sub("", value.strip().lower())
 
 
 def resolve_headers(fieldnames):
@@ -77,36 +164,58 @@ def resolve_headers(fieldnames):
     return mapping
 
 
-def normalize_row(row, mapping):
-    normalized = {
-        key: (row.get(raw_name) or "").strip()
-        for raw_name, key in mapping.items()
-    }
+def make_normalizer(mapping):
+    # Returns a function that normalizes one row for this header mapping.
+    # Lookups are bound once so normalize_rows() can run it over large blocks.
+    items = tuple(mapping.items())
+    split = split_name
+    titled = title_case
+    default_last = DEFAULT_LAST_NAME
 
-    if not normalized.get("name"):
-        first = normalized.get("firstName", "")
-        last = normalized.get("lastName", "")
-        combined = f"{first} {last}".strip()
-        if combined:
-            normalized["name"] = combined
+    def normalize(row):
+        get = row.get
+        normalized = {}
+        for raw_name, key in items:
+            normalized[key] = (get(raw_name) or "").strip()
 
-    if normalized.get("name") and (
-        not normalized.get("firstName") or not normalized.get("lastName")
-    ):
-        first, last = split_name(normalized["name"])
-        if not normalized.get("firstName") and first:
-            normalized["firstName"] = first
-        if not normalized.get("lastName") and last:
-            normalized["lastName"] = last
+        name = normalized.get("name")
+        first = normalized.get("firstName")
+        last = normalized.get("lastName")
+
+        if not name:
+            combined = f"{first or ''} {last or ''}".strip()
+            if combined:
+                name = normalized["name"] = combined
+
+        if name and (not first or not last):
+            split_first, split_last = split(name)
+            if not first and split_first:
+                first = normalized["firstName"] = split_first
+            if not last and split_last:
+                last = normalized["lastName"] = split_last
+
+        if not last:
+            last = normalized["lastName"] = default_last
+
+        if name:
+            normalized["name"] = titled(name)
+        if first:
+            normalized["firstName"] = titled(first)
+        normalized["lastName"] = titled(last)
 
-    if not normalized.get("lastName"):
-        normalized["lastName"] = DEFAULT_LAST_NAME
+        return normalized
 
-    for key in ("name", "firstName", "lastName"):
-        if normalized.get(key):
-            normalized[key] = title_case(normalized[key])
+    return normalize
 
-    return normalized
+
+def normalize_row(row, mapping):
+    return make_normalizer(mapping)(row)
+
+
+def normalize_rows(rows, mapping):
+    # Batch path for large files: same output as normalize_row() per row.
+    normalize = make_normalizer(mapping)
+    return [normalize(row) for row in rows]
 
 
 def split_name(full_name: str):
@@ -119,31 +228,194 @@ def split_name(full_name: str):
 
 
 def name_parts(value: str):
-    return re.findall(r"\S+", value or "")
+    return _NAME_PART_RE.findall(value or "")
 
 
-def title_case(value: str) -> str:
-    def repl(match):
-        word = match.group(0)
-        return word[:1].upper() + word[1:].lower()
+def _title_word(match):
+    word = match.group(0)
+    return word[:1].upper() + word[1:].lower()
+
 
-    return re.sub(r"[^\W\d_]+", repl, value, flags=re.UNICODE)
+@lru_cache(maxsize=TITLE_CASE_CACHE_SIZE)
+def title_case(value: str) -> str:
+    return _WORD_RE.sub(_title_word, value)
 
 
+@lru_cache(maxsize=CANONICAL_CACHE_SIZE)
 def normalize_role(role_raw):
     if not role_raw:
         return ""
     return ROLE_ALIASES.get(canonicalize(role_raw), "")
 
 
-def load_template(role):
-    path = TEMPLATE_PATHS[role]
+def read_template(path):
     if not path.exists():
         raise FileNotFoundError(f"Template not found: {path}")
     with path.open("r", encoding="utf-8") as handle:
         return json.load(handle)
 
 
+def _dumps(value):
+    return json.dumps(value, ensure_ascii=False)
+
+
+def scopes_hash(scopes):
+    return hashlib.sha1(_dumps(scopes).encode("utf-8")).hexdigest()[:16]
+
+
+USER_BODY_KEYS = frozenset(
+    (
+        "companyId",
+        "firstName",
+        "lastName",
+        "email",
+        "phone",
+        "type",
+        "role",
+        "locationIds",
+        "permissions",
+    )
+)
+
+
+class UserBody(dict):
+    # Request body built from a CompiledTemplate. It is the same dict that
+    # build_body() returns, but encode_body() fills the personal fields into
+    # the template's pre-serialized skeleton instead of re-encoding the large
+    # permissions and scopes blocks for every row. A body changed outside the
+    # personal fields no longer matches its skeleton and is encoded in full.
+    __slots__ = ("template", "company_id", "location_ids")
+
+    def pristine(self):
+        template = self.template
+        keys = self.keys()
+        if "scopes" in self:
+            if self["scopes"] is not template.scopes or len(keys) != 10:
+                return False
+        elif len(keys) != 9:
+            return False
+        return (
+            USER_BODY_KEYS <= keys
+            and self["companyId"] == self.company_id
+            and self["locationIds"] is self.location_ids
+            and self["type"] == template.role_type
+            and self["role"] == template.role
+            and self["permissions"] is template.permissions
+        )
+
+    def encode(self):
+        if not self.pristine():
+            return json.dumps(self, ensure_ascii=False).encode("utf-8")
+        head, tail = self.template.skeleton(
+            self.company_id, self.location_ids, "scopes" in self
+        )
+        personal = (
+            f'"firstName": {_dumps(self["firstName"])}, '
+            f'"lastName": {_dumps(self["lastName"])}, '
+            f'"email": {_dumps(self["email"])}, '
+            f'"phone": {_dumps(self["phone"])}, '
+        )
+        return b"".join((head, personal.encode("utf-8"), tail))
+
+    def without_scopes(self):
+        body = UserBody(self)
+        body.pop("scopes", None)
+        body.template = self.template
+        body.company_id = self.company_id
+        body.location_ids = self.location_ids
+        return body
+
+
+class CompiledTemplate:
+    # A role template parsed once, with type/role resolved and the constant
+    # parts of the request body serialized per (companyId, locationIds).
+
+    def __init__(self, role, path, mtime, data):
+        self.name = role
+        self.path = path
+        self.mtime = mtime
+        self.checked = time.monotonic()
+        self.data = data
+        roles = data.get("roles", {})
+        self.role_type = data.get("type") or roles.get("type")
+        self.role = data.get("role") or roles.get("role")
+        self.permissions = data.get("permissions", {})
+        self.scopes = data.get("scopes")
+        self.scopes_hash = scopes_hash(self.scopes)
+        self._skeletons = {}
+
+    def skeleton(self, company_id, location_ids, with_scopes=True):
+        key = (company_id, tuple(location_ids), bool(with_scopes and self.scopes))
+        cached = self._skeletons.get(key)
+        if cached is None:
+            head = f'{{"companyId": {_dumps(company_id)}, '
+            tail = (
+                f'"type": {_dumps(self.role_type)}, '
+                f'"role": {_dumps(self.role)}, '
+                f'"locationIds": {_dumps(list(location_ids))}, '
+                f'"permissions": {_dumps(self.permissions)}'
+            )
+            if key[2]:
+                tail += f', "scopes": {_dumps(self.scopes)}'
+            cached = (head.encode("utf-8"), (tail + "}").encode("utf-8"))
+            self._skeletons[key] = cached
+        return cached
+
+    def body(self, row, company_id, location_ids):
+        if not self.role_type or not self.role:
+            raise ValueError("Template missing role/type fields.")
+
+        body = UserBody(
+            companyId=company_id,
+            firstName=row["firstName"],
+            lastName=row.get("lastName", ""),
+            email=row["email"],
+            phone=row["phone"],
+            type=self.role_type,
+            role=self.role,
+            locationIds=location_ids,
+            permissions=self.permissions,
+        )
+        if self.scopes:
+            body["scopes"] = self.scopes
+        body.template = self
+        body.company_id = company_id
+        body.location_ids = location_ids
+        return body
+
+
+_TEMPLATE_CACHE = {}
+_TEMPLATE_LOCK = threading.Lock()
+
+
+def compile_template(role):
+    # Templates are parsed once and re-read only when the file's mtime
+    # changes (checked at most every TEMPLATE_CHECK_INTERVAL seconds).
+    path = TEMPLATE_PATHS[role]
+    now = time.monotonic()
+    cached = _TEMPLATE_CACHE.get(role)
+    if cached is not None and now - cached.checked < TEMPLATE_CHECK_INTERVAL:
+        return cached
+
+    with _TEMPLATE_LOCK:
+        cached = _TEMPLATE_CACHE.get(role)
+        try:
+            mtime = path.stat().st_mtime_ns
+        except FileNotFoundError:
+            _TEMPLATE_CACHE.pop(role, None)
+            raise FileNotFoundError(f"Template not found: {path}") from None
+        if cached is not None and cached.mtime == mtime:
+            cached.checked = now
+            return cached
+        compiled = CompiledTemplate(role, path, mtime, read_template(path))
+        _TEMPLATE_CACHE[role] = compiled
+        return compiled
+
+
+def load_template(role):
+    return compile_template(role).data
+
+
 def build_body(template, row, company_id, location_ids):
     roles = template.get("roles", {})
     role_type = template.get("type") or roles.get("type")
@@ -170,6 +442,319 @@ def build_body(template, row, company_id, location_ids):
     return body
 
 
+def build_request_headers(token, api_version, user_agent, has_body, headers=None):
+    merged = {
+        "Authorization": f"Bearer {token}",
+        "Accept": "application/json",
+        "User-Agent": user_agent,
+    }
+    if has_body:
+        merged["Content-Type"] = "application/json"
+    if api_version:
+        merged["Version"] = api_version
+    if headers:
+        for key, value in headers.items():
+            if value:
+                merged[key] = value
+    return merged
+
+
+def encode_body(body):
+    if body is None:
+        return None
+    if isinstance(body, (bytes, bytearray)):
+        return body
+    if isinstance(body, UserBody):
+        return body.encode()
+    return json.dumps(body, ensure_ascii=False).encode("utf-8")
+
+
+def strip_scopes(body):
+    if isinstance(body, UserBody):
+        return body.without_scopes()
+    stripped = dict(body)
+    stripped.pop("scopes", None)
+    return stripped
+
+
+class ConnectionPool:
+    # Keep-alive HTTP(S) connections shared by every request_api call. Idle
+    # connections are kept per (scheme, host, port) up to max_size and are
+    # dropped once they sit unused for longer than idle_timeout seconds.
+
+    def __init__(
+        self, max_size=POOL_SIZE_DEFAULT, idle_timeout=POOL_IDLE_TIMEOUT_DEFAULT
+    ):
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.opened = 0
+        self.reused = 0
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def configure(self, max_size=None, idle_timeout=None):
+        with self._lock:
+            if max_size is not None:
+                self.max_size = max(1, max_size)
+            if idle_timeout is not None:
+                self.idle_timeout = idle_timeout
+
+    def acquire(self, key, timeout):
+        now = time.monotonic()
+        with self._lock:
+            idle = self._idle.get(key)
+            while idle:
+                conn, last_used = idle.pop()
+                if now - last_used <= self.idle_timeout and not is_dropped(conn):
+                    self.reused += 1
+                    conn.timeout = timeout
+                    if conn.sock is not None:
+                        conn.sock.settimeout(timeout)
+                    return conn, True
+                conn.close()
+            self.opened += 1
+
+        scheme, host, port = key
+        if scheme == "https":
+            cls = http.client.HTTPSConnection
+        else:
+            cls = http.client.HTTPConnection
+        proxy = proxy_for(scheme, host)
+        if proxy is None:
+            return cls(host, port, timeout=timeout), False
+        conn = cls(proxy.hostname, proxy.port or 80, timeout=timeout)
+        conn.set_tunnel(host, port, headers=proxy_headers(proxy))
+        return conn, False
+
+    def release(self, key, conn):
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self.max_size:
+                idle.append((conn, time.monotonic()))
+                return
+        conn.close()
+
+    def stats(self):
+        with self._lock:
+            idle = sum(len(conns) for conns in self._idle.values())
+            return {"opened": self.opened, "reused": self.reused, "idle": idle}
+
+    def reset_stats(self):
+        with self._lock:
+            self.opened = 0
+            self.reused = 0
+
+    def close(self):
+        with self._lock:
+            conns = [conn for idle in self._idle.values() for conn, _ in idle]
+            self._idle.clear()
+        for conn in conns:
+            conn.close()
+
+
+def proxy_for(scheme, host):
+    # HTTPS_PROXY / HTTP_PROXY / NO_PROXY, as urllib.request.urlopen reads
+    # them. Both schemes go through the proxy with a CONNECT tunnel.
+    proxy = urllib.request.getproxies().get(scheme)
+    if not proxy or urllib.request.proxy_bypass(host):
+        return None
+    if "://" not in proxy:
+        proxy = "http://" + proxy
+    return parse.urlsplit(proxy)
+
+
+def proxy_headers(proxy):
+    if proxy.username is None:
+        return None
+    user = parse.unquote(proxy.username)
+    credentials = f"{user}:{parse.unquote(proxy.password or '')}"
+    token = base64.b64encode(credentials.encode("utf-8")).decode("ascii")
+    return {"Proxy-Authorization": f"Basic {token}"}
+
+
+def is_dropped(conn):
+    # An idle keep-alive socket that polls readable was closed by the server
+    # (or holds data nobody asked for); it cannot carry another request.
+    sock = conn.sock
+    if sock is None:
+        return False
+    try:
+        if hasattr(select, "poll"):
+            poller = select.poll()
+            poller.register(sock, select.POLLIN)
+            return bool(poller.poll(0))
+        return bool(select.select([sock], [], [], 0)[0])
+    except (OSError, ValueError):
+        return True
+
+
+HTTP_POOL = ConnectionPool()
+
+
+def parse_retry_after(value):
+    if not value:
+        return None
+    value = value.strip()
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        moment = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if moment is None:
+        return None
+    return max(0.0, moment.timestamp() - time.time())
+
+
+def header_float(headers, name):
+    try:
+        return float(headers.get(name))
+    except (TypeError, ValueError):
+        return None
+
+
+class RateLimiter:
+    # Token bucket shared by every outgoing request. The rate starts at the
+    # ceiling, is halved on each 429 and climbs back by a small step after
+    # every successful response. Retry-After and X-RateLimit-* headers pause
+    # the bucket until the API says traffic is allowed again.
+
+    def __init__(self, max_rate=MAX_RPS_DEFAULT, min_rate=0.5):
+        self.min_rate = min_rate
+        self.throttled = 0
+        self._lock = threading.Lock()
+        self.configure(max_rate)
+
+    def configure(self, max_rate):
+        with self._lock:
+            self.max_rate = max_rate or None
+            self.rate = self.max_rate
+            self.tokens = max(1.0, self.rate or 1.0)
+            self.updated = time.monotonic()
+            self.blocked_until = 0.0
+
+    def _refill(self, now):
+        burst = max(1.0, self.rate)
+        self.tokens = min(burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self):
+        # Takes a token and returns how long the caller must wait before
+        # sending. Tokens may go negative so concurrent callers queue up.
+        with self._lock:
+            now = time.monotonic()
+            wait = max(0.0, self.blocked_until - now)
+            if self.rate:
+                self._refill(now)
+                self.tokens -= 1
+                if self.tokens < 0:
+                    wait = max(wait, -self.tokens / self.rate)
+            return wait
+
+    def acquire(self):
+        wait = self.reserve()
+        if wait:
+            time.sleep(wait)
+
+    def observe(self, status, headers):
+        retry_after = parse_retry_after(headers.get("Retry-After"))
+        remaining = header_float(headers, "X-RateLimit-Remaining")
+        interval_ms = header_float(headers, "X-RateLimit-Interval-Milliseconds")
+        reset = header_float(headers, "X-RateLimit-Reset")
+        if reset is not None and reset > 10 ** 9:
+            # Epoch timestamp rather than seconds from now.
+            reset = max(0.0, reset - time.time())
+        window = reset if reset is not None else (
+            interval_ms / 1000.0 if interval_ms is not None else None
+        )
+
+        with self._lock:
+            now = time.monotonic()
+            if status == 429:
+                self.throttled += 1
+                pause = retry_after if retry_after is not None else window
+                self.blocked_until = max(self.blocked_until, now + (pause or 1.0))
+                if self.rate:
+                    self.rate = max(self.min_rate, self.rate / 2)
+                    self.tokens = min(self.tokens, 0.0)
+                return
+
+            if retry_after is not None:
+                self.blocked_until = max(self.blocked_until, now + retry_after)
+            if remaining is not None and remaining <= 0 and window:
+                self.blocked_until = max(self.blocked_until, now + window)
+
+            if not self.rate:
+                return
+            ceiling = self.max_rate
+            if remaining is not None and window:
+                # Never plan to spend the remaining quota faster than the
+                # window allows.
+                ceiling = min(ceiling, max(self.min_rate, remaining / window))
+            step = self.max_rate * 0.05
+            self.rate = max(self.min_rate, min(ceiling, self.rate + step))
+
+
+RATE_LIMITER = RateLimiter()
+
+
+class RetryPolicy:
+    # Decides which failures are retried and how long to back off. GET is
+    # idempotent, so any network error or gateway status is retried. POST is
+    # only retried when the API cannot have created the user: the request
+    # never left this process, or the service refused it with 503. A 502 or
+    # 504 comes after the request was forwarded, so the user may exist.
+    RETRY_STATUSES = {"GET": {500, 502, 503, 504}, "POST": {503}}
+
+    def __init__(
+        self,
+        retries=RETRIES_DEFAULT,
+        backoff=RETRY_BACKOFF_DEFAULT,
+        max_backoff=RETRY_BACKOFF_MAX,
+    ):
+        self.configure(retries, backoff, max_backoff)
+
+    def configure(self, retries=None, backoff=None, max_backoff=None):
+        if retries is not None:
+            self.retries = max(0, retries)
+        if backoff is not None:
+            self.backoff = max(0.0, backoff)
+        if max_backoff is not None:
+            self.max_backoff = max_backoff
+
+    def retry_status(self, method, status):
+        return status in self.RETRY_STATUSES.get(method, ())
+
+    def retry_error(self, method, exc, sent):
+        if not isinstance(exc, (OSError, http.client.HTTPException)):
+            return False
+        return method == "GET" or not sent
+
+    def delay(self, attempt, deadline=None):
+        # Exponential backoff with full jitter. Returns None once the retry
+        # budget or the row deadline is exhausted.
+        if attempt >= self.retries:
+            return None
+        wait = random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+        if deadline is not None and time.monotonic() + wait >= deadline:
+            return None
+        return wait
+
+
+RETRY_POLICY = RetryPolicy()
+
+
+def remaining_timeout(timeout, deadline):
+    if deadline is None:
+        return timeout
+    remaining = deadline - time.monotonic()
+    if remaining <= 0:
+        raise socket.timeout("row deadline exceeded")
+    return min(timeout, remaining)
+
+
 def request_api(
     method,
     base_url,
@@ -180,35 +765,109 @@ def request_api(
     body=None,
     headers=None,
     timeout=30.0,
+    pool=None,
+    limiter=None,
+    retry=None,
+    deadline=None,
+    info=None,
+    profiler=None,
 ):
-    url = base_url.rstrip("/") + path
-    payload = None
-    if body is not None:
-        payload = json.dumps(body, ensure_ascii=False).encode("utf-8")
-
-    req = request.Request(url, data=payload, method=method)
-    req.add_header("Authorization", f"Bearer {token}")
-    req.add_header("Accept", "application/json")
-    req.add_header("User-Agent", user_agent)
-    if body is not None:
-        req.add_header("Content-Type", "application/json")
-    if api_version:
-        req.add_header("Version", api_version)
-    if headers:
-        for key, value in headers.items():
-            if value:
-                req.add_header(key, value)
+    # info, when given, collects the number of retries made for this call
+    # and the headers of the final response. profiler, when given, times the
+    # encode, rate-limit, http and backoff stages.
+    pool = pool or HTTP_POOL
+    limiter = limiter or RATE_LIMITER
+    retry = retry or RETRY_POLICY
+    url = parse.urlsplit(base_url.rstrip("/") + path)
+    key = (url.scheme, url.hostname, url.port)
+    endpoint = url.path or "/"
+    target = endpoint
+    if url.query:
+        target += "?" + url.query
+
+    with profiling.stage(profiler, "encode"):
+        payload = encode_body(body)
+    merged = build_request_headers(
+        token, api_version, user_agent, body is not None, headers
+    )
 
-    try:
-        with request.urlopen(req, timeout=timeout) as response:
-            raw = response.read().decode("utf-8")
-            return response.status, raw
-    except error.HTTPError as http_err:
-        raw = http_err.read().decode("utf-8")
-        return http_err.code, raw
+    throttled = 0
+    attempt = 0
+    stale_retried = False
+    while True:
+        with profiling.stage(profiler, "rate-limit"):
+            limiter.acquire()
+        conn, reused = pool.acquire(key, remaining_timeout(timeout, deadline))
+        sent = False
+        outcome = "error"
+        metrics.UPSTREAM_IN_FLIGHT.inc()
+        started = time.perf_counter()
+        try:
+            with profiling.stage(profiler, "http"):
+                conn.request(method, target, body=payload, headers=merged)
+                sent = True
+                response = conn.getresponse()
+                raw = response.read().decode("utf-8")
+            outcome = str(response.status)
+        except (http.client.RemoteDisconnected, ConnectionError) as exc:
+            conn.close()
+            # The server may close an idle keep-alive connection at any time;
+            # send again once on a fresh connection, unless a POST already went
+            # out and the user may have been created.
+            if reused and not stale_retried and retry.retry_error(method, exc, sent):
+                stale_retried = True
+                continue
+            wait = retry.delay(attempt, deadline)
+            if wait is None or not retry.retry_error(method, exc, sent):
+                raise
+        except Exception as exc:
+            conn.close()
+            wait = retry.delay(attempt, deadline)
+            if wait is None or not retry.retry_error(method, exc, sent):
+                raise
+        else:
+            if response.will_close:
+                conn.close()
+            else:
+                pool.release(key, conn)
+
+            limiter.observe(response.status, response.headers)
+            if info is not None:
+                info["headers"] = response.headers
+            if response.status == 429 and throttled < RATE_LIMIT_RETRIES:
+                # The limiter has already paused for Retry-After; send again.
+                throttled += 1
+                continue
+            wait = None
+            if retry.retry_status(method, response.status):
+                wait = retry.delay(attempt, deadline)
+            if wait is None:
+                return response.status, raw
+        finally:
+            metrics.UPSTREAM_IN_FLIGHT.dec()
+            metrics.UPSTREAM_LATENCY.observe(
+                time.perf_counter() - started, method, endpoint, outcome
+            )
+
+        attempt += 1
+        if info is not None:
+            info["retries"] = info.get("retries", 0) + 1
+        with profiling.stage(profiler, "backoff"):
+            time.sleep(wait)
 
 
-def post_user(base_url, token, api_version, body, timeout, user_agent, location_id):
+def post_user(
+    base_url,
+    token,
+    api_version,
+    body,
+    timeout,
+    user_agent,
+    location_id,
+    deadline=None,
+    info=None,
+    profiler=None,
+):
     headers = {"LocationId": location_id} if location_id else None
     return request_api(
         "POST",
@@ -220,12 +879,15 @@ def post_user(base_url, token, api_version, body, timeout, user_agent, location_
         body=body,
         headers=headers,
         timeout=timeout,
+        deadline=deadline,
+        info=info,
+        profiler=profiler,
     )
 
 
 
 
-def parse_args():
+def parse_args(argv=None):
     parser = argparse.ArgumentParser(
         description="Create GHL users from a CSV using role templates."
     )
@@ -269,6 +931,67 @@ def parse_args():
         default=0.0,
         help="Delay in seconds between requests",
     )
+    parser.add_argument(
+        "--max-rps",
+        type=float,
+        default=MAX_RPS_DEFAULT,
+        help="Requests-per-second ceiling for the adaptive rate limiter "
+        "(0 disables the ceiling; 429/Retry-After are always honored)",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of rows processed concurrently (default: 1); with "
+        "--location-ids this is the cap per location",
+    )
+    parser.add_argument(
+        "--location-ids",
+        help="Comma-separated location IDs; every CSV row is created in each "
+        "of them, or with --list-users all of them are listed into one export",
+    )
+    parser.add_argument(
+        "--location-ids-file",
+        help="File with one location ID per line (same as --location-ids)",
+    )
+    parser.add_argument(
+        "--location-workers",
+        type=int,
+        default=LOCATION_WORKERS_DEFAULT,
+        help="Locations imported in parallel with --location-ids "
+        f"(default: {LOCATION_WORKERS_DEFAULT})",
+    )
+    parser.add_argument(
+        "--retries",
+        type=int,
+        default=RETRIES_DEFAULT,
+        help="Retries for transient failures (timeouts, resets, 502/503/504)",
+    )
+    parser.add_argument(
+        "--retry-backoff",
+        type=float,
+        default=RETRY_BACKOFF_DEFAULT,
+        help="Base delay in seconds for exponential backoff with jitter",
+    )
+    parser.add_argument(
+        "--row-deadline",
+        type=float,
+        default=ROW_DEADLINE_DEFAULT,
+        help="Total seconds allowed per row including retries (0 disables)",
+    )
+    parser.add_argument(
+        "--pool-size",
+        type=int,
+        default=POOL_SIZE_DEFAULT,
+        help="Max idle keep-alive connections kept per host "
+        "(raised to --workers if lower)",
+    )
+    parser.add_argument(
+        "--pool-idle-timeout",
+        type=float,
+        default=POOL_IDLE_TIMEOUT_DEFAULT,
+        help="Seconds an idle connection is kept before being discarded",
+    )
     parser.add_argument(
         "--timeout",
         type=float,
@@ -278,13 +1001,70 @@ def parse_args():
     parser.add_argument(
         "--dry-run",
         action="store_true",
-        help="Print payloads without sending requests",
+        help="Validate rows and write the payloads to --dry-run-report without "
+        "sending requests",
+    )
+    parser.add_argument(
+        "--dry-run-format",
+        choices=DRY_RUN_FORMATS,
+        default="ndjson",
+        help="Dry-run report: one JSON line per row with its body (ndjson) or "
+        "only counts per role and per error with sample rows (summary)",
+    )
+    parser.add_argument(
+        "--dry-run-report",
+        help=f"Dry-run report path (default {DEFAULT_DRY_RUN_REPORT}, or "
+        f"{DEFAULT_DRY_RUN_SUMMARY} for the summary)",
     )
     parser.add_argument(
         "--stop-on-error",
         action="store_true",
         help="Stop on first request error",
     )
+    parser.add_argument(
+        "--skip-existing",
+        action="store_true",
+        help="Skip rows whose email or phone already belongs to a user "
+        "(checked against a fresh listing or --existing-users)",
+    )
+    parser.add_argument(
+        "--existing-users",
+        help="Local users export (JSON or CSV from --list-users) used by "
+        "--skip-existing instead of fetching the list",
+    )
+    parser.add_argument(
+        "--journal",
+        dest="journal_path",
+        default=str(JOURNAL_PATH_DEFAULT),
+        help="Append-only journal of row outcomes used by --resume",
+    )
+    parser.add_argument(
+        "--no-journal",
+        action="store_true",
+        help="Do not record row outcomes in the journal",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Skip rows the journal already records as created for this CSV "
+        "and location",
+    )
+    parser.add_argument(
+        "--scope-outcomes",
+        default=str(SCOPE_OUTCOMES_PATH),
+        help="File that remembers templates whose scopes the API rejects",
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="Time each import stage (CSV, normalize, template, encode, HTTP...) "
+        "and print a breakdown at the end",
+    )
+    parser.add_argument(
+        "--profile-out",
+        help="Also record the import with cProfile and save a pstats dump here "
+        "(implies --profile)",
+    )
     parser.add_argument(
         "--list-users",
         action="store_true",
@@ -296,6 +1076,48 @@ def parse_args():
         default=100,
         help="Page size for listing users",
     )
+    parser.add_argument(
+        "--cache-ttl",
+        type=float,
+        default=USERS_CACHE_TTL_DEFAULT,
+        help="Seconds a cached user listing is served without revalidation "
+        "(0 disables the cache)",
+    )
+    parser.add_argument(
+        "--refresh",
+        action="store_true",
+        help="Ignore the cached user listing and download it again",
+    )
+    parser.add_argument(
+        "--sync",
+        action="store_true",
+        help="Compare the listing with the previous --users-json snapshot, "
+        "write the differences to --users-diff and rewrite the snapshot files "
+        "only when something changed",
+    )
+    parser.add_argument(
+        "--locations-summary",
+        default=DEFAULT_LOCATIONS_SUMMARY,
+        help="Output JSON path for the per-location summary of "
+        "--list-users --location-ids",
+    )
+    parser.add_argument(
+        "--users-diff",
+        default=DEFAULT_USERS_DIFF,
+        help="Output JSON path for the --sync diff",
+    )
+    parser.add_argument(
+        "--users-format",
+        choices=USERS_FORMATS,
+        default="json",
+        help="Users JSON export layout: indented json, compact json or ndjson "
+        "(one user per line, written to users_existing.ndjson by default)",
+    )
+    parser.add_argument(
+        "--gzip",
+        action="store_true",
+        help="Gzip the user exports (adds .gz to the output paths)",
+    )
     parser.add_argument(
         "--users-json",
         default=DEFAULT_USERS_JSON,
@@ -306,7 +1128,7 @@ def parse_args():
         default=DEFAULT_USERS_CSV,
         help="Output CSV path for listed users",
     )
-    return parser.parse_args()
+    return parser.parse_args(argv)
 
 
 def resolve_location_ids(args, template):
@@ -335,6 +1157,106 @@ def should_retry_without_scopes(status, body, response_body):
     )
 
 
+class ScopeOutcomes:
+    # Remembers, per (template, scopes, location), that the API rejects the
+    # scopes field, so later rows go out without it instead of paying for a
+    # 422 and a second POST each time. Persisted as JSON between runs.
+
+    def __init__(
+        self,
+        path=SCOPE_OUTCOMES_PATH,
+        probe_rows=SCOPE_PROBE_ROWS,
+        probe_interval=SCOPE_PROBE_INTERVAL,
+    ):
+        self.path = Path(path)
+        self.probe_rows = probe_rows
+        self.probe_interval = probe_interval
+        self._lock = threading.Lock()
+        self._rejected = None
+        self._stripped = {}
+
+    def configure(self, path):
+        # A different file drops what was loaded from the previous one.
+        path = Path(path).resolve()
+        with self._lock:
+            if path != self.path:
+                self.path = path
+                self._rejected = None
+                self._stripped = {}
+
+    def _load(self):
+        if self._rejected is None:
+            try:
+                with self.path.open("r", encoding="utf-8") as handle:
+                    self._rejected = json.load(handle)
+            except (OSError, ValueError):
+                self._rejected = {}
+        return self._rejected
+
+    def load(self):
+        with self._lock:
+            self._load()
+
+    def save(self):
+        with self._lock:
+            self._save()
+
+    def _save(self):
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = self.path.with_suffix(".json.tmp")
+            with tmp.open("w", encoding="utf-8") as handle:
+                json.dump(self._rejected, handle, indent=2, sort_keys=True)
+            os.replace(tmp, self.path)
+        except OSError:
+            pass
+
+    def key(self, body, location_id):
+        if isinstance(body, UserBody) and body.pristine():
+            name, digest = body.template.name, body.template.scopes_hash
+        else:
+            name, digest = "-", scopes_hash(body.get("scopes"))
+        return f"{name}:{digest}:{location_id}"
+
+    def send_scopes(self, key):
+        # False while the scopes are known to be rejected, except for the
+        # occasional probe. Only one caller gets each probe.
+        with self._lock:
+            rejected_at = self._load().get(key)
+            if rejected_at is None:
+                return True
+            stripped = self._stripped.get(key, 0) + 1
+            if (
+                stripped <= self.probe_rows
+                and time.time() - rejected_at < self.probe_interval
+            ):
+                self._stripped[key] = stripped
+                return False
+            self._stripped[key] = 0
+            self._rejected[key] = time.time()
+            return True
+
+    def record(self, key, rejected, persist=True):
+        # Returns True when the outcomes changed. With persist=False the file
+        # is left for the caller to write with save() (async_api does it off
+        # the event loop).
+        with self._lock:
+            known = self._load().get(key) is not None
+            if rejected:
+                self._rejected[key] = time.time()
+            elif known:
+                del self._rejected[key]
+                self._stripped.pop(key, None)
+            else:
+                return False
+            if persist:
+                self._save()
+        return True
+
+
+SCOPE_OUTCOMES = ScopeOutcomes()
+
+
 def fetch_users(
     base_url,
     token,
@@ -344,6 +1266,8 @@ def fetch_users(
     limit,
     skip,
     timeout,
+    headers=None,
+    info=None,
 ):
     # Location ID is sent as query parameter, NOT as header
     # Note: GHL API does not accept limit/skip parameters for this endpoint
@@ -362,121 +1286,1501 @@ def fetch_users(
         token,
         api_version,
         user_agent,
-        headers=None,
+        headers=headers,
         timeout=timeout,
+        info=info,
     )
 
 
-def fetch_all_users(args, location_id):
-    # GHL API returns all users in a single request (no pagination needed)
-    status, raw = fetch_users(
-        args.base_url,
-        args.token,
-        args.api_version,
-        args.user_agent,
-        location_id,
-        None,  # limit not used
-        None,  # skip not used
-        args.timeout,
+def _freeze(value):
+    # Hashable form of a decoded JSON value. Non-string scalars keep their
+    # type so true, 1 and 1.0 stay apart.
+    if isinstance(value, dict):
+        return ("{*",) + tuple((key, _freeze(item)) for key, item in value.items())
+    if isinstance(value, list):
+        return ("[*",) + tuple(_freeze(item) for item in value)
+    if isinstance(value, str):
+        return value
+    return (type(value), value)
+
+
+def _flat_key(value):
+    # Cheaper key for the common case of a dict or list of scalars (scopes,
+    # permissions); it cannot be hashed when something is nested.
+    if isinstance(value, dict):
+        values = tuple(value.values())
+        return ("{", tuple(value), values, tuple(map(type, values)))
+    values = tuple(value)
+    return ("[", values, tuple(map(type, values)))
+
+
+def _shared(value, table):
+    # Returns the first equal value seen through table, so identical roles,
+    # permissions and scopes blocks are stored once per listing. Shared values
+    # are read-only.
+    if not isinstance(value, (dict, list)):
+        return value
+    try:
+        return table.setdefault(_flat_key(value), value)
+    except TypeError:
+        return table.setdefault(_freeze(value), value)
+
+
+class UserRecord:
+    # One listed user, decoded once from the API payload. The fields read by
+    # summaries, CSV exports, diffs and the existing-users index are slots;
+    # the rest (permissions, scopes, ...) are kept in `extra`, in key order.
+    # roles, the key layout and the large extra values are shared between
+    # users. to_dict() rebuilds the API dict with its original key order, so
+    # JSON exports are unchanged; get(), [] and `in` mirror the dict.
+    __slots__ = (
+        "id",
+        "name",
+        "firstName",
+        "lastName",
+        "email",
+        "phone",
+        "deleted",
+        "dateAdded",
+        "dateUpdated",
+        "roles",
+        "layout",
+        "extra",
     )
+    FIELDS = frozenset(__slots__[:10])
+
+    @classmethod
+    def from_dict(cls, user, table):
+        record = cls.__new__(cls)
+        fields = cls.FIELDS
+        extra = []
+        for key in fields:
+            setattr(record, key, None)
+        for key, value in user.items():
+            if key in fields:
+                setattr(record, key, _shared(value, table) if key == "roles" else value)
+            else:
+                extra.append(_shared(value, table))
+        record.layout = table.setdefault(("layout",) + tuple(user), tuple(user))
+        record.extra = tuple(extra)
+        return record
+
+    def to_dict(self):
+        fields = self.FIELDS
+        extra = iter(self.extra)
+        return {
+            key: getattr(self, key) if key in fields else next(extra)
+            for key in self.layout
+        }
+
+    def get(self, key, default=None):
+        if key not in self.layout:
+            return default
+        if key in self.FIELDS:
+            return getattr(self, key)
+        return self.to_dict()[key]
+
+    def __getitem__(self, key):
+        if key not in self.layout:
+            raise KeyError(key)
+        return self.get(key)
+
+    def __contains__(self, key):
+        return key in self.layout
+
+    def __eq__(self, other):
+        if isinstance(other, UserRecord):
+            other = other.to_dict()
+        return self.to_dict() == other
+
+    def csv_row(self):
+        roles = self.roles or {}
+        return {
+            "id": _or(self.id, ""),
+            "name": _or(self.name, ""),
+            "firstName": _or(self.firstName, ""),
+            "lastName": _or(self.lastName, ""),
+            "email": _or(self.email, ""),
+            "phone": _or(self.phone, ""),
+            "role": roles.get("role", ""),
+            "type": roles.get("type", ""),
+            "locationIds": ",".join(roles.get("locationIds") or []),
+            "deleted": _or(self.deleted, ""),
+            "dateAdded": _or(self.dateAdded, ""),
+            "dateUpdated": _or(self.dateUpdated, ""),
+        }
+
+    def summary(self):
+        # Flat view used by the server's /list response.
+        row = self.csv_row()
+        row["locationIds"] = (self.roles or {}).get("locationIds") or []
+        row["deleted"] = _or(self.deleted, False)
+        return row
+
+
+def _or(value, default):
+    return default if value is None else value
+
+
+def decode_users(users):
+    # Listing payload -> UserRecords sharing roles, scopes and permissions.
+    table = {}
+    return [
+        user if isinstance(user, UserRecord) else UserRecord.from_dict(user, table)
+        for user in users
+    ]
+
+
+def users_hook():
+    # json object_hook that turns each user object into a UserRecord as soon
+    # as the parser closes it, so a listing is never held as full dicts.
+    # Users are told apart from nested objects by their id and roles; anything
+    # missed is still converted by decode_users().
+    table = {}
+
+    def hook(obj):
+        if "id" in obj and "roles" in obj:
+            return UserRecord.from_dict(obj, table)
+        return obj
+
+    return hook
+
+
+def loads_users(raw):
+    return json.loads(raw, object_hook=users_hook())
+
+
+def user_json(value):
+    # json.dump(default=...) hook that serializes UserRecords as their dict.
+    if isinstance(value, UserRecord):
+        return value.to_dict()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+class UsersCache:
+    # Per-location cache of GET /users/ listings, kept in memory and on disk.
+    # Entries hold the validators needed for conditional revalidation and a
+    # hash of the raw body for servers that send neither ETag nor
+    # Last-Modified.
+
+    def __init__(self, directory=USERS_CACHE_DIR):
+        self.directory = Path(directory)
+        self._memory = {}
+        self._lock = threading.Lock()
+
+    def _path(self, location_id):
+        safe = re.sub(r"[^A-Za-z0-9_-]", "_", location_id)
+        return self.directory / f"{safe}.json"
+
+    def get(self, location_id):
+        with self._lock:
+            entry = self._memory.get(location_id)
+        if entry is not None:
+            return entry
+        try:
+            with self._path(location_id).open("r", encoding="utf-8") as handle:
+                entry = json.load(handle, object_hook=users_hook())
+        except (OSError, ValueError):
+            return None
+        entry["users"] = decode_users(entry.get("users") or [])
+        with self._lock:
+            self._memory[location_id] = entry
+        return entry
+
+    def put(self, location_id, entry, persist=True):
+        with self._lock:
+            self._memory[location_id] = entry
+        if not persist:
+            return
+        path = self._path(location_id)
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = path.with_suffix(".json.tmp")
+            with tmp.open("w", encoding="utf-8") as handle:
+                json.dump(
+                    entry,
+                    handle,
+                    ensure_ascii=False,
+                    separators=(",", ":"),
+                    default=user_json,
+                )
+            os.replace(tmp, path)
+        except OSError:
+            pass
+
+    def touch(self, location_id, entry):
+        # Revalidated without changes: only the timestamp moves, so the disk
+        # copy is left alone and its age is tracked in memory.
+        entry = dict(entry, fetchedAt=time.time())
+        self.put(location_id, entry, persist=False)
+        return entry
+
+    def invalidate(self, location_id):
+        with self._lock:
+            self._memory.pop(location_id, None)
+        path = self._path(location_id)
+        if path.exists():
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                pass
+
+
+USERS_CACHE = UsersCache()
+
+
+def fetch_all_users(args, location_id, refresh=None, cache=None):
+    # GHL API returns all users in a single request (no pagination needed).
+    # Listings are cached per location for --cache-ttl seconds; after that
+    # they are revalidated with If-None-Match/If-Modified-Since, or compared
+    # by content hash when the API sends no validators.
+    cache = cache or USERS_CACHE
+    ttl = getattr(args, "cache_ttl", USERS_CACHE_TTL_DEFAULT) or 0
+    if refresh is None:
+        refresh = getattr(args, "refresh", False)
+
+    entry = cache.get(location_id) if ttl > 0 else None
+    if entry is not None and not refresh:
+        if time.time() - entry["fetchedAt"] < ttl:
+            return 200, "", entry["users"], entry["total"]
+
+    conditional = {}
+    if entry is not None and not refresh:
+        conditional["If-None-Match"] = entry.get("etag")
+        conditional["If-Modified-Since"] = entry.get("lastModified")
+
+    info = {}
+    try:
+        status, raw = fetch_users(
+            args.base_url,
+            args.token,
+            args.api_version,
+            args.user_agent,
+            location_id,
+            None,  # limit not used
+            None,  # skip not used
+            args.timeout,
+            headers=conditional,
+            info=info,
+        )
+    except (OSError, http.client.HTTPException) as exc:
+        return 0, f"{type(exc).__name__}: {exc}", [], None
+
+    if status == 304 and entry is not None:
+        entry = cache.touch(location_id, entry)
+        return 200, "", entry["users"], entry["total"]
 
     if status != 200:
         return status, raw, [], None
 
+    digest = hashlib.sha256(raw.encode("utf-8")).hexdigest()
+    if entry is not None and entry.get("hash") == digest:
+        entry = cache.touch(location_id, entry)
+        return 200, "", entry["users"], entry["total"]
+
     try:
-        payload = json.loads(raw)
+        payload = loads_users(raw)
     except json.JSONDecodeError:
         return 500, raw, [], None
 
-    users = payload.get("users", [])
+    users = decode_users(payload.get("users", []))
     total = payload.get("count", len(users))
 
+    if ttl > 0:
+        headers = info.get("headers") or {}
+        cache.put(
+            location_id,
+            {
+                "fetchedAt": time.time(),
+                "etag": headers.get("ETag"),
+                "lastModified": headers.get("Last-Modified"),
+                "hash": digest,
+                "total": total,
+                "users": users,
+            },
+        )
+
     return 200, "", users, total
 
 
-def write_users_json(path, users, location_id):
-    # Location ID and Company ID are the same thing
+def users_file_kind(path):
+    # Returns (format suffix, gzip-compressed) for an export path such as
+    # "users.ndjson.gz".
+    path = Path(path)
+    if path.suffix.lower() == ".gz":
+        return Path(path.stem).suffix.lower(), True
+    return path.suffix.lower(), False
+
+
+def open_users_file(path, mode="r", newline=None, compressed=None):
+    if compressed is None:
+        compressed = users_file_kind(path)[1]
+    # utf-8-sig skips the BOM of CSVs saved by spreadsheet tools.
+    encoding = "utf-8-sig" if mode == "r" else "utf-8"
+    if compressed:
+        return gzip.open(path, mode + "t", encoding=encoding, newline=newline)
+    return open(path, mode, encoding=encoding, newline=newline)
+
+
+@contextmanager
+def atomic_writer(path, newline=None):
+    # Writes to a temporary file next to path and renames it into place once
+    # everything is written, so an interrupted export never replaces the
+    # previous file with a partial one. Paths ending in .gz are compressed.
+    path = Path(path)
+    tmp = path.with_name(f".{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    try:
+        compressed = users_file_kind(path)[1]
+        with open_users_file(tmp, "w", newline, compressed) as handle:
+            yield handle
+        os.replace(tmp, path)
+    except BaseException:
+        try:
+            tmp.unlink()
+        except OSError:
+            pass
+        raise
+
+
+def export_paths(args):
+    # Applies --users-format and --gzip to the export file names.
+    json_path = args.users_json
+    if getattr(args, "users_format", "json") == "ndjson":
+        if json_path == DEFAULT_USERS_JSON:
+            json_path = DEFAULT_USERS_NDJSON
+    paths = [json_path, args.users_csv, args.users_diff]
+    if getattr(args, "gzip", False):
+        paths = [path if path.endswith(".gz") else path + ".gz" for path in paths]
+    return paths
+
+
+def write_users_json(path, users, location_id, fmt="json", location_ids=None):
+    # Users are serialized one at a time instead of dumping a single payload;
+    # "json" keeps the indented layout of json.dump(indent=2), "compact" drops
+    # the whitespace and "ndjson" writes one user per line without the header.
+    # Merged exports of several locations list them in locationIds instead.
+    with atomic_writer(path) as handle:
+        if fmt == "ndjson":
+            for user in users:
+                line = json.dumps(
+                    user, ensure_ascii=False, separators=(",", ":"), default=user_json
+                )
+                handle.write(line + "\n")
+            return
+
+        indent, separators = (2, None) if fmt == "json" else (None, (",", ":"))
+        if location_ids is not None:
+            header = {"count": len(users), "locationIds": location_ids, "users": []}
+        else:
+            # Location ID and Company ID are the same thing
+            header = {
+                "count": len(users),
+                "companyId": location_id,
+                "locationId": location_id,
+                "users": [],
+            }
+        text = json.dumps(
+            header, ensure_ascii=False, indent=indent, separators=separators
+        )
+        head, tail = text.rsplit("[]", 1)
+        handle.write(head + "[")
+        first = True
+        for user in users:
+            item = json.dumps(
+                user,
+                ensure_ascii=False,
+                indent=indent,
+                separators=separators,
+                default=user_json,
+            )
+            if indent:
+                item = "\n    " + item.replace("\n", "\n    ")
+            handle.write(item if first else "," + item)
+            first = False
+        if indent and not first:
+            handle.write("\n  ")
+        handle.write("]" + tail)
+
+
+def write_users_csv(path, users):
+    with atomic_writer(path, newline="") as handle:
+        writer = csv.DictWriter(handle, fieldnames=USERS_CSV_FIELDS)
+        writer.writeheader()
+        for user in decode_users(users):
+            writer.writerow(user.csv_row())
+
+
+def read_users_payload(path):
+    # Parsed export: the JSON payload, or a list of users for CSV and NDJSON.
+    kind = users_file_kind(path)[0]
+    with open_users_file(path, "r", newline="") as handle:
+        if kind == ".csv":
+            return list(csv.DictReader(handle))
+        hook = users_hook()
+        if kind in (".ndjson", ".jsonl"):
+            return [
+                json.loads(line, object_hook=hook) for line in handle if line.strip()
+            ]
+        return json.load(handle, object_hook=hook)
+
+
+def read_snapshot(path, location_id):
+    # Users from a previous write_users_json() snapshot of the same location,
+    # or None when there is no usable snapshot. NDJSON snapshots carry no
+    # location, so they are trusted as they are.
+    try:
+        payload = read_users_payload(path)
+    except (OSError, EOFError, ValueError):
+        return None
+    if isinstance(payload, list):
+        return decode_users(payload)
+    if not isinstance(payload, dict) or payload.get("locationId") != location_id:
+        return None
+    users = payload.get("users")
+    return decode_users(users) if isinstance(users, list) else None
+
+
+def user_changed(old, new):
+    # dateUpdated is cheaper and more reliable than comparing every field,
+    # but not every user has it.
+    old_stamp = old.dateUpdated
+    new_stamp = new.dateUpdated
+    if old_stamp and new_stamp:
+        return old_stamp != new_stamp
+    return old != new
+
+
+def diff_users(previous, current):
+    previous_by_id = {user.id: user for user in previous if user.id}
+    added = []
+    changed = []
+    seen = set()
+    for user in current:
+        user_id = user.id
+        old = previous_by_id.get(user_id)
+        if old is None:
+            added.append(user)
+        elif user_changed(old, user):
+            changed.append(user)
+        seen.add(user_id)
+    removed = [user_id for user_id in previous_by_id if user_id not in seen]
+    return {"added": added, "changed": changed, "removed": removed}
+
+
+def write_users_diff(path, diff, location_id, previous_count, count):
     payload = {
-        "count": len(users),
-        "companyId": location_id,
         "locationId": location_id,
-        "users": users,
+        "generatedAt": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "previousCount": previous_count,
+        "count": count,
+        "added": diff["added"],
+        "changed": diff["changed"],
+        "removed": diff["removed"],
     }
-    with open(path, "w", encoding="utf-8") as handle:
-        json.dump(payload, handle, ensure_ascii=False, indent=2)
+    with atomic_writer(path) as handle:
+        json.dump(
+            payload,
+            handle,
+            ensure_ascii=False,
+            separators=(",", ":"),
+            default=user_json,
+        )
 
 
-def write_users_csv(path, users):
-    fieldnames = [
-        "id",
-        "name",
-        "firstName",
-        "lastName",
-        "email",
-        "phone",
-        "role",
-        "type",
-        "locationIds",
-        "deleted",
-        "dateAdded",
-        "dateUpdated",
-    ]
+def write_users_files(args, users, location_id, location_ids=None):
+    fmt = getattr(args, "users_format", "json")
+    write_users_json(args.users_json, users, location_id, fmt, location_ids)
+    write_users_csv(args.users_csv, users)
 
-    with open(path, "w", encoding="utf-8", newline="") as handle:
-        writer = csv.DictWriter(handle, fieldnames=fieldnames)
-        writer.writeheader()
+
+def fetch_locations_users(args, location_ids, workers=LOCATION_WORKERS_DEFAULT):
+    # Lists several locations concurrently. Returns (users, summaries): the
+    # users merged in location order without repeated ids, and one summary
+    # per location. A failed location is reported and the others go on.
+    def fetch(location_id):
+        try:
+            return fetch_all_users(args, location_id)
+        except Exception as exc:
+            return 0, f"{type(exc).__name__}: {exc}", [], None
+
+    workers = max(1, min(workers, len(location_ids)))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        listings = list(executor.map(fetch, location_ids))
+
+    users = []
+    seen = set()
+    summaries = []
+    for location_id, (status, raw, listed, total) in zip(location_ids, listings):
+        summary = {"locationId": location_id, "status": status}
+        if status != 200:
+            summary["error"] = response_snippet(raw)
+            summaries.append(summary)
+            continue
+        added = 0
+        for user in listed:
+            user_id = user.id
+            if user_id:
+                if user_id in seen:
+                    continue
+                seen.add(user_id)
+            users.append(user)
+            added += 1
+        summary.update({"count": len(listed), "total": total, "new": added})
+        summaries.append(summary)
+    return users, summaries
+
+
+def write_locations_summary(path, summaries):
+    with atomic_writer(path) as handle:
+        json.dump(summaries, handle, ensure_ascii=False, indent=2)
+
+
+def list_locations(args, location_ids):
+    users, summaries = fetch_locations_users(
+        args, location_ids, args.location_workers
+    )
+    write_users_files(args, users, None, location_ids)
+    write_locations_summary(args.locations_summary, summaries)
+
+    failed = 0
+    for summary in summaries:
+        if summary["status"] == 200:
+            print(
+                f"  {summary['locationId']}: {summary['count']} users "
+                f"({summary['new']} not seen in earlier locations)"
+            )
+        else:
+            failed += 1
+            print(
+                f"  {summary['locationId']}: failed ({summary['status']}) -> "
+                f"{summary['error']}"
+            )
+    print(
+        f"Users stored: {len(users)} from {len(location_ids) - failed} of "
+        f"{len(location_ids)} locations -> {args.users_json}, {args.users_csv}, "
+        f"{args.locations_summary}"
+    )
+    return 1 if failed else 0
+
+
+def sync_users(args, users, location_id):
+    # Diffs the listing against the previous snapshot by user id. The diff is
+    # always written (an empty diff tells downstream jobs there is nothing to
+    # do); the snapshot files are only rewritten when something changed.
+    # Returns (diff, snapshot_written).
+    previous = read_snapshot(args.users_json, location_id)
+    diff = diff_users(previous or [], users)
+    write_users_diff(
+        args.users_diff,
+        diff,
+        location_id,
+        len(previous) if previous is not None else None,
+        len(users),
+    )
+    changed = previous is None or any(diff.values())
+    if changed:
+        write_users_files(args, users, location_id)
+    return diff, changed
+
+
+def diff_summary(diff):
+    return (
+        f"added {len(diff['added'])}, changed {len(diff['changed'])}, "
+        f"removed {len(diff['removed'])}"
+    )
+
+
+def email_key(value):
+    return (value or "").strip().lower()
+
+
+def phone_key(value):
+    digits = _NON_DIGIT_RE.sub("", value or "")
+    if len(digits) > 11 and digits.startswith(DEFAULT_COUNTRY_CODE):
+        digits = digits[len(DEFAULT_COUNTRY_CODE):]
+    if len(digits) < MIN_PHONE_KEY_LENGTH:
+        return ""
+    return digits
+
+
+class ExistingUsers:
+    # Hash index of users that already exist, keyed by normalized email and
+    # phone. Rows are claimed as they are checked, so repeated people inside
+    # the same CSV are skipped as well. A claim stays pending until settle():
+    # it is kept once the row is created (or would be, in a dry run) and
+    # dropped otherwise, so a failed row never hides its later duplicates. A
+    # duplicate of a pending row waits for it to settle before deciding.
+    SETTLED_STATUSES = ("created", "dry-run")
+
+    def __init__(self, users=()):
+        self.by_email = {}
+        self.by_phone = {}
+        self.count = 0
+        self._claims = {}
+        self._lock = threading.Lock()
         for user in users:
-            roles = user.get("roles") or {}
-            location_ids = roles.get("locationIds") or []
-            writer.writerow(
+            self._add(user.get("email"), user.get("phone"), user)
+            self.count += 1
+
+    def __len__(self):
+        return self.count
+
+    def _add(self, email, phone, entry):
+        key = email_key(email)
+        if key:
+            self.by_email.setdefault(key, entry)
+        key = phone_key(phone)
+        if key:
+            self.by_phone.setdefault(key, entry)
+
+    def claim(self, index, email, phone):
+        # Returns the matching entry, or registers this row and returns None.
+        with self._lock:
+            match = self.by_email.get(email_key(email)) or self.by_phone.get(
+                phone_key(phone)
+            )
+            if match is None:
+                entry = {"row": index, "pending": True}
+                self._add(email, phone, entry)
+                self._claims[index] = (entry, email, phone, [])
+            elif "row" in match:
+                match = dict(match)
+            return match
+
+    def claim_settled(self, index, email, phone):
+        # claim(), but waits for a pending row to settle and claims again, so
+        # the match returned (if any) is an existing or created user.
+        while True:
+            match = self.claim(index, email, phone)
+            if match is None or not match.get("pending"):
+                return match
+            settled = threading.Event()
+            self.when_settled(match["row"], settled.set)
+            settled.wait()
+
+    def when_settled(self, row, callback):
+        # Calls callback() once the claim of row is settled, right away when
+        # it already is. Callbacks run on the thread that settles the claim.
+        with self._lock:
+            claim = self._claims.get(row)
+            if claim is not None:
+                claim[3].append(callback)
+                return
+        callback()
+
+    def settle(self, index, result):
+        # result is the claimed row's result, or None if processing raised.
+        with self._lock:
+            claim = self._claims.pop(index, None)
+            if claim is None:
+                return
+            entry, email, phone, waiters = claim
+            if result is not None and result["status"] in self.SETTLED_STATUSES:
+                entry["pending"] = False
+            else:
+                for index_map, key in (
+                    (self.by_email, email_key(email)),
+                    (self.by_phone, phone_key(phone)),
+                ):
+                    if key and index_map.get(key) is entry:
+                        del index_map[key]
+        for callback in waiters:
+            callback()
+
+
+def read_users_file(path):
+    payload = read_users_payload(path)
+    if isinstance(payload, list):
+        return payload
+    return payload.get("users", [])
+
+
+def load_existing_users(args):
+    # Builds the pre-flight index from --existing-users or a fresh listing.
+    # Returns (index, error_message).
+    path = getattr(args, "existing_users", None)
+    if path:
+        try:
+            return ExistingUsers(read_users_file(path)), None
+        except (OSError, ValueError) as exc:
+            return None, f"Unable to read existing users from {path}: {exc}"
+
+    location_id = args.location_id or args.company_id
+    if not location_id:
+        for role in TEMPLATE_PATHS:
+            try:
+                location_ids = resolve_location_ids(args, load_template(role))
+            except FileNotFoundError:
+                continue
+            if location_ids:
+                location_id = location_ids[0]
+                break
+    if not location_id:
+        return None, "Provide --location-id to check existing users."
+
+    status, raw, users, _ = fetch_all_users(args, location_id)
+    if status != 200:
+        return None, f"List users failed ({status}) -> {response_snippet(raw)}"
+    return ExistingUsers(users), None
+
+
+def existing_result(index, match):
+    if "id" in match:
+        message = f"already exists (id {match['id']})"
+    else:
+        message = f"already exists (duplicate of row {match['row']})"
+    return {"row": index, "status": "skipped", "message": message}
+
+
+def row_hash(row):
+    values = "\x1f".join(str(value or "") for value in row.values())
+    return hashlib.sha1(values.encode("utf-8")).hexdigest()
+
+
+class ImportJournal:
+    # Append-only NDJSON log of posted rows keyed by (CSV path, row hash,
+    # location). Lines are buffered and written with a single fsync per batch
+    # of JOURNAL_FLUSH_ROWS rows or JOURNAL_FLUSH_INTERVAL seconds; close()
+    # writes whatever is left.
+
+    def __init__(
+        self,
+        path,
+        csv_path,
+        resume=False,
+        flush_rows=JOURNAL_FLUSH_ROWS,
+        flush_interval=JOURNAL_FLUSH_INTERVAL,
+    ):
+        self.path = Path(path)
+        self.csv_path = str(Path(csv_path).resolve())
+        self.flush_rows = flush_rows
+        self.flush_interval = flush_interval
+        self.created = self._load() if resume else set()
+        self._buffer = []
+        self._lock = threading.Lock()
+        self._last_flush = time.monotonic()
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._handle = self.path.open("a", encoding="utf-8")
+        if self._handle.tell() and not self._ends_with_newline():
+            # A crash in the middle of a write leaves a torn last line.
+            self._handle.write("\n")
+
+    def _ends_with_newline(self):
+        with self.path.open("rb") as handle:
+            handle.seek(-1, os.SEEK_END)
+            return handle.read(1) == b"\n"
+
+    def _load(self):
+        created = set()
+        try:
+            handle = self.path.open("r", encoding="utf-8")
+        except FileNotFoundError:
+            return created
+        with handle:
+            for line in handle:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                if entry.get("csv") != self.csv_path:
+                    continue
+                # Once created, a row stays created: a later run that failed
+                # on it (e.g. 400 "already exists") must not clear that.
+                if entry.get("status") == "created":
+                    created.add((entry.get("hash"), entry.get("location")))
+        return created
+
+    def key(self, row, location_id):
+        return row_hash(row), location_id
+
+    def done(self, key):
+        return key in self.created
+
+    def record(self, key, result):
+        entry = {
+            "csv": self.csv_path,
+            "hash": key[0],
+            "location": key[1],
+            "row": result["row"],
+            "status": result["status"],
+            "at": round(time.time(), 3),
+        }
+        if "code" in result:
+            entry["code"] = result["code"]
+        if "elapsed" in result:
+            entry["elapsed"] = result["elapsed"]
+        line = json.dumps(entry, ensure_ascii=False, separators=(",", ":"))
+        with self._lock:
+            self._buffer.append(line)
+            if (
+                len(self._buffer) >= self.flush_rows
+                or time.monotonic() - self._last_flush >= self.flush_interval
+            ):
+                self._flush()
+
+    def _flush(self):
+        if self._buffer:
+            self._handle.write("\n".join(self._buffer) + "\n")
+            self._handle.flush()
+            os.fsync(self._handle.fileno())
+            self._buffer = []
+        self._last_flush = time.monotonic()
+
+    def close(self):
+        with self._lock:
+            if not self._handle.closed:
+                self._flush()
+                self._handle.close()
+
+
+def journal_result(index):
+    return {"row": index, "status": "skipped", "message": "already created (journal)"}
+
+
+def response_snippet(response_body, limit=500):
+    snippet = (response_body or "").strip()
+    if len(snippet) > limit:
+        snippet = snippet[:limit] + "..."
+    return snippet
+
+
+def row_error(index, message):
+    return {"row": index, "status": "error", "message": message}
+
+
+def prepare_row(index, row, mapping, args, normalized=None):
+    # Returns (error_result, role, body, location_id); error_result is set
+    # when the row cannot be sent. normalized skips normalize_row() for rows
+    # that went through normalize_rows() already.
+    profiler = getattr(args, "profiler", None)
+    if normalized is None:
+        with profiling.stage(profiler, "normalize"):
+            normalized = normalize_row(row, mapping)
+    missing = [field for field in REQUIRED_FIELDS if not normalized.get(field, "")]
+    if missing:
+        return (
+            row_error(index, f"missing fields: {', '.join(sorted(missing))}"),
+            None,
+            None,
+            None,
+        )
+
+    role = normalize_role(normalized["role"])
+    if not role:
+        return (
+            row_error(
+                index,
+                f"invalid role '{normalized['role']}'. "
+                "Use Vendedor or Administrador.",
+            ),
+            None,
+            None,
+            None,
+        )
+
+    try:
+        with profiling.stage(profiler, "template"):
+            compiled = compile_template(role)
+    except FileNotFoundError as exc:
+        result = row_error(index, str(exc))
+        result["fatal"] = True
+        return result, role, None, None
+
+    template = compiled.data
+    location_ids = resolve_location_ids(args, template)
+    if not location_ids:
+        return (
+            row_error(index, "missing locationIds in template or args."),
+            role,
+            None,
+            None,
+        )
+
+    company_id = resolve_company_id(args, template, location_ids)
+    if not company_id:
+        return row_error(index, "unable to resolve companyId."), role, None, None
+
+    try:
+        with profiling.stage(profiler, "build"):
+            body = compiled.body(normalized, company_id, location_ids)
+    except ValueError as exc:
+        return row_error(index, str(exc)), role, None, None
+
+    location_id = args.location_id or location_ids[0]
+    return None, role, body, location_id
+
+
+def row_deadline(args):
+    seconds = getattr(args, "row_deadline", None)
+    return time.monotonic() + seconds if seconds else None
+
+
+def send_body(args, body, location_id, info=None):
+    deadline = row_deadline(args)
+    profiler = getattr(args, "profiler", None)
+    scope_key = None
+    if "scopes" in body:
+        scope_key = SCOPE_OUTCOMES.key(body, location_id)
+        if not SCOPE_OUTCOMES.send_scopes(scope_key):
+            metrics.SCOPE_RETRIES.inc("learned")
+            body = strip_scopes(body)
+
+    status, response_body = post_user(
+        args.base_url,
+        args.token,
+        args.api_version,
+        body,
+        args.timeout,
+        args.user_agent,
+        location_id,
+        deadline=deadline,
+        info=info,
+        profiler=profiler,
+    )
+
+    if scope_key is not None and "scopes" in body and status in (200, 201):
+        SCOPE_OUTCOMES.record(scope_key, False)
+    if should_retry_without_scopes(status, body, response_body):
+        metrics.SCOPE_RETRIES.inc("rejected")
+        SCOPE_OUTCOMES.record(scope_key, True)
+        body_no_scopes = strip_scopes(body)
+        status, response_body = post_user(
+            args.base_url,
+            args.token,
+            args.api_version,
+            body_no_scopes,
+            args.timeout,
+            args.user_agent,
+            location_id,
+            deadline=deadline,
+            info=info,
+            profiler=profiler,
+        )
+
+    return status, response_body
+
+
+def post_result(index, status, response_body, retries=0):
+    if status in (200, 201):
+        result = {"row": index, "status": "created", "code": status}
+    else:
+        result = {
+            "row": index,
+            "status": "failed",
+            "code": status,
+            "message": response_snippet(response_body),
+        }
+    if retries:
+        result["retries"] = retries
+    return result
+
+
+def network_failure(index, exc, retries=0):
+    # Status 0 means no HTTP response was received.
+    return post_result(index, 0, f"{type(exc).__name__}: {exc}", retries)
+
+
+def process_row(index, row, mapping, args, stop=None, normalized=None):
+    # Validates, builds and (unless dry-run) posts a single CSV row.
+    error_result, role, body, location_id = prepare_row(
+        index, row, mapping, args, normalized
+    )
+    if error_result:
+        return error_result
+
+    journal = getattr(args, "journal", None)
+    key = None
+    if journal is not None:
+        key = journal.key(row, location_id)
+        if journal.done(key):
+            return journal_result(index)
+
+    existing = getattr(args, "existing", None)
+    if existing is None:
+        return post_row(index, role, body, location_id, args, stop, key)
+    match = existing.claim_settled(index, body["email"], body["phone"])
+    if match is not None:
+        return existing_result(index, match)
+    result = None
+    try:
+        result = post_row(index, role, body, location_id, args, stop, key)
+    finally:
+        existing.settle(index, result)
+    return result
+
+
+def post_row(index, role, body, location_id, args, stop=None, journal_key=None):
+    if args.dry_run:
+        return {"row": index, "status": "dry-run", "role": role, "body": body}
+
+    if stop is not None and stop.is_set():
+        return {"row": index, "status": "cancelled"}
+
+    info = {"retries": 0}
+    started = time.monotonic()
+    try:
+        status, response_body = send_body(args, body, location_id, info)
+    except (OSError, http.client.HTTPException) as exc:
+        result = network_failure(index, exc, info["retries"])
+    else:
+        result = post_result(index, status, response_body, info["retries"])
+        if status in (200, 201):
+            USERS_CACHE.invalidate(location_id)
+    # Seconds spent sending the row, retries included.
+    result["elapsed"] = round(time.monotonic() - started, 4)
+    if args.delay:
+        time.sleep(args.delay)
+
+    journal = getattr(args, "journal", None)
+    if journal is not None:
+        with profiling.stage(getattr(args, "profiler", None), "journal"):
+            journal.record(journal_key, result)
+    return result
+
+
+def is_failure(result):
+    return result["status"] in ("error", "failed")
+
+
+def iter_row_results(reader, mapping, args, normalized=None):
+    # Yields one result per CSV row, in row order. With --workers > 1 rows are
+    # processed through a bounded pool; closing the generator cancels queued
+    # rows and keeps in-flight ones from posting. normalized, when given, is
+    # the normalize_rows() output for the same rows; otherwise rows go
+    # through one normalizer built for the mapping.
+    profiler = getattr(args, "profiler", None)
+    if normalized is None:
+        if profiler is not None:
+            reader = profiler.iterate("csv", reader)
+        normalize = make_normalizer(mapping)
+
+        def pre_for(index, row):
+            with profiling.stage(profiler, "normalize"):
+                return normalize(row)
+
+    else:
+
+        def pre_for(index, row):
+            return normalized[index - 2]
+
+    rows = enumerate(reader, start=2)
+    workers = max(1, getattr(args, "workers", 1) or 1)
+    if workers == 1:
+        for index, row in rows:
+            yield process_row(index, row, mapping, args, normalized=pre_for(index, row))
+        return
+
+    stop = threading.Event()
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        try:
+            for index, row in rows:
+                pre = pre_for(index, row)
+                task = (process_row, index, row, mapping, args, stop, pre)
+                if profiler is not None:
+                    task = (profiler.call,) + task
+                pending.append(executor.submit(*task))
+                # Keep at most two rows queued per worker so a large CSV is
+                # never read into memory up front.
+                if len(pending) >= workers * 2:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+        finally:
+            stop.set()
+            for future in pending:
+                future.cancel()
+
+
+def print_result(result):
+    index = result["row"]
+    status = result["status"]
+    retries = result.get("retries")
+    note = f" (retries: {retries})" if retries else ""
+    if status == "created":
+        print(f"Row {index}: created ({result['code']}){note}")
+    elif status == "failed":
+        print(f"Row {index}: failed ({result['code']}){note} -> {result['message']}")
+    elif status == "dry-run":
+        body = encode_body(result["body"]).decode("utf-8")
+        print(f"Row {index}: {result['role']} -> {body}")
+    elif status == "skipped":
+        print(f"Row {index}: skipped -> {result['message']}")
+    elif status == "error":
+        if result.get("fatal"):
+            print(result["message"])
+        else:
+            print(f"Row {index}: {result['message']}")
+
+
+class DryRunReport:
+    # --dry-run output. Rows are counted by role and by error message (with
+    # the first DRY_RUN_SAMPLE_ROWS row numbers of each error); the ndjson
+    # format also writes every row, body included, through a large buffered
+    # file. On a terminal stdout only shows a progress line.
+
+    def __init__(self, path, fmt="ndjson", progress=True):
+        self.path = path
+        self.fmt = fmt
+        self.rows = 0
+        self.counts = {"valid": 0, "invalid": 0, "skipped": 0}
+        self.roles = {}
+        self.errors = {}
+        self._handle = None
+        if fmt == "ndjson":
+            self._handle = open(path, "wb", buffering=DRY_RUN_BUFFER_SIZE)
+        self._progress = progress and sys.stdout.isatty()
+        self._next_progress = 0.0
+        self.closed = False
+
+    def add(self, result, location_id=None):
+        self.rows += 1
+        status = result["status"]
+        if status == "dry-run":
+            self.counts["valid"] += 1
+            self.roles[result["role"]] = self.roles.get(result["role"], 0) + 1
+        elif status == "skipped":
+            self.counts["skipped"] += 1
+        else:
+            self.counts["invalid"] += 1
+            entry = self.errors.get(result["message"])
+            if entry is None:
+                entry = self.errors[result["message"]] = {"count": 0, "rows": []}
+            entry["count"] += 1
+            if len(entry["rows"]) < DRY_RUN_SAMPLE_ROWS:
+                entry["rows"].append(result["row"])
+
+        if self._handle is not None:
+            self._handle.write(self.encode(result, location_id))
+        if self._progress:
+            now = time.monotonic()
+            if now >= self._next_progress:
+                self._next_progress = now + DRY_RUN_PROGRESS_INTERVAL
+                self.print_progress()
+
+    def encode(self, result, location_id=None):
+        line = {key: value for key, value in result.items() if key != "body"}
+        if location_id:
+            line["locationId"] = location_id
+        if "body" not in result:
+            return (json.dumps(line, ensure_ascii=False) + "\n").encode("utf-8")
+        # The body keeps the pre-serialized template parts (encode_body).
+        head = json.dumps(line, ensure_ascii=False)[:-1] + ', "body": '
+        return b"".join((head.encode("utf-8"), encode_body(result["body"]), b"}\n"))
+
+    def print_progress(self, end=""):
+        counts = self.counts
+        sys.stdout.write(
+            f"\rDry-run: {self.rows} rows, valid {counts['valid']}, "
+            f"invalid {counts['invalid']}, skipped {counts['skipped']}{end}"
+        )
+        sys.stdout.flush()
+
+    def summary(self):
+        errors = sorted(self.errors.items(), key=lambda item: -item[1]["count"])
+        return {
+            "rows": self.rows,
+            **self.counts,
+            "roles": self.roles,
+            "errors": [
                 {
-                    "id": user.get("id", ""),
-                    "name": user.get("name", ""),
-                    "firstName": user.get("firstName", ""),
-                    "lastName": user.get("lastName", ""),
-                    "email": user.get("email", ""),
-                    "phone": user.get("phone", ""),
-                    "role": roles.get("role", ""),
-                    "type": roles.get("type", ""),
-                    "locationIds": ",".join(location_ids),
-                    "deleted": user.get("deleted", ""),
-                    "dateAdded": user.get("dateAdded", ""),
-                    "dateUpdated": user.get("dateUpdated", ""),
+                    "message": message,
+                    "count": entry["count"],
+                    "sampleRows": entry["rows"],
                 }
-            )
+                for message, entry in errors
+            ],
+        }
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if self._progress:
+            self._progress = False
+            self.print_progress("\n")
+        if self._handle is not None:
+            self._handle.close()
+            self._handle = None
+        elif self.fmt == "summary":
+            with atomic_writer(self.path) as handle:
+                json.dump(self.summary(), handle, ensure_ascii=False, indent=2)
+                handle.write("\n")
+
+    def print_errors(self, limit=5):
+        for item in self.summary()["errors"][:limit]:
+            rows = ", ".join(str(row) for row in item["sampleRows"])
+            print(f"  {item['count']}x {item['message']} (rows {rows})")
+        if len(self.errors) > limit:
+            print(f"  ... {len(self.errors) - limit} more kinds of error in the report")
+
+
+def print_dry_run_report(report):
+    print(f"Dry-run report ({report.fmt}): {report.path}")
+    if report.errors:
+        print("Errors by message:")
+        report.print_errors()
+
+
+def open_dry_run_report(args, progress=True):
+    if not args.dry_run:
+        return None
+    return DryRunReport(args.dry_run_report, args.dry_run_format, progress)
+
+
+def read_location_ids(args):
+    # --location-ids and --location-ids-file combined, in order and without
+    # repeats. The file takes one ID per line; blank lines and # comments are
+    # ignored.
+    location_ids = (args.location_ids or "").split(",")
+    if args.location_ids_file:
+        with open(args.location_ids_file, "r", encoding="utf-8") as handle:
+            location_ids.extend(line.split("#", 1)[0] for line in handle)
+    return list(dict.fromkeys(value.strip() for value in location_ids if value.strip()))
+
+
+def location_args(args, location_id):
+    scoped = argparse.Namespace(**vars(args))
+    scoped.location_id = location_id
+    # Company ID and Location ID are the same thing
+    scoped.company_id = None
+    scoped.existing = None
+    return scoped
+
+
+def count_results(results):
+    successes = failures = skipped = 0
+    for result in results:
+        if is_failure(result):
+            failures += 1
+        elif result["status"] == "skipped":
+            skipped += 1
+        else:
+            successes += 1
+    return successes, failures, skipped
+
+
+def run_location(location_id, rows, normalized, mapping, args, cancel):
+    # Imports every row into one location with the row-level --workers cap.
+    report = {"locationId": location_id, "error": None, "results": []}
+    if cancel.is_set():
+        report["error"] = "not started (import stopped)"
+        return report
+    scoped = location_args(args, location_id)
+    if args.skip_existing:
+        scoped.existing, report["error"] = load_existing_users(scoped)
+        if report["error"]:
+            return report
+
+    results = iter_row_results(rows, mapping, scoped, normalized)
+    try:
+        for result in results:
+            report["results"].append(result)
+            if cancel.is_set():
+                break
+            if result.get("fatal") or (is_failure(result) and args.stop_on_error):
+                # Stops the whole run, not just this location.
+                cancel.set()
+                break
+    finally:
+        results.close()
+    return report
+
+
+def print_location_report(report, dry_run_report=None):
+    # With a dry-run report, rows go to the report and only the location's
+    # totals (and a fatal error, if any) are printed.
+    print(f"== Location {report['locationId']}")
+    if report["error"]:
+        print(report["error"])
+        return
+    for result in report["results"]:
+        if dry_run_report is None:
+            print_result(result)
+            continue
+        dry_run_report.add(result, report["locationId"])
+        if result.get("fatal"):
+            print_result(result)
+    successes, failures, skipped = count_results(report["results"])
+    print(
+        f"Location {report['locationId']}: Success: {successes}, "
+        f"Failed: {failures}, Skipped: {skipped}"
+    )
+
+
+def import_csv_locations(csv_path, args, location_ids):
+    # Fan-out mode: the CSV is read and normalized once, then imported into
+    # up to --location-workers locations at a time. Each location is printed
+    # as one block when it finishes, followed by a summary in input order.
+    with csv_path.open("r", encoding="utf-8-sig", newline="") as handle:
+        reader = csv.DictReader(handle)
+        if not reader.fieldnames:
+            print("CSV has no headers.")
+            return 2
+        mapping = resolve_headers(reader.fieldnames)
+        if not mapping:
+            print("No recognized headers found in CSV.")
+            return 2
+        with profiling.stage(args.profiler, "csv"):
+            rows = list(reader)
+    with profiling.stage(args.profiler, "normalize"):
+        normalized = normalize_rows(rows, mapping)
+    print(f"Rows: {len(rows)}, locations: {len(location_ids)}")
+
+    location_workers = max(1, min(args.location_workers, len(location_ids)))
+    HTTP_POOL.configure(
+        max_size=max(args.pool_size, location_workers * max(1, args.workers))
+    )
+    cancel = threading.Event()
+    reports = {}
+    # Locations print as blocks, so the report skips the progress line.
+    dry_run_report = open_dry_run_report(args, progress=False)
+    with ThreadPoolExecutor(max_workers=location_workers) as executor:
+        task = (run_location,)
+        if args.profiler is not None:
+            task = (args.profiler.call, run_location)
+        futures = [
+            executor.submit(*task, location_id, rows, normalized, mapping, args, cancel)
+            for location_id in location_ids
+        ]
+        try:
+            for future in as_completed(futures):
+                report = future.result()
+                reports[report["locationId"]] = report
+                with profiling.stage(args.profiler, "output"):
+                    print_location_report(report, dry_run_report)
+        finally:
+            # Ctrl-C: queued locations never start and running ones stop
+            # after their current row.
+            cancel.set()
+            for future in futures:
+                future.cancel()
+            if dry_run_report is not None:
+                dry_run_report.close()
+
+    fatal = False
+    totals = [0, 0, 0]
+    failed_locations = []
+    print("Summary by location:")
+    for location_id in location_ids:
+        report = reports[location_id]
+        counts = count_results(report["results"])
+        totals = [total + count for total, count in zip(totals, counts)]
+        fatal = fatal or any(result.get("fatal") for result in report["results"])
+        if report["error"] or counts[1]:
+            failed_locations.append(location_id)
+        note = f" -> {report['error']}" if report["error"] else ""
+        print(
+            f"  {location_id}: Success: {counts[0]}, Failed: {counts[1]}, "
+            f"Skipped: {counts[2]}{note}"
+        )
+    print(
+        f"Done. Locations: {len(location_ids)} "
+        f"(with failures: {len(failed_locations)}), Success: {totals[0]}, "
+        f"Failed: {totals[1]}, Skipped: {totals[2]}"
+    )
+    if dry_run_report is not None:
+        print_dry_run_report(dry_run_report)
+    if not args.dry_run:
+        print_transport_stats()
+    if fatal:
+        return 2
+    return 1 if failed_locations else 0
 
 
-def row_failure(index, message, args):
-    print(f"Row {index}: {message}")
-    return args.stop_on_error
+def configure_transport(args):
+    HTTP_POOL.configure(
+        max_size=max(args.pool_size, getattr(args, "workers", 1) or 1),
+        idle_timeout=args.pool_idle_timeout,
+    )
+    RATE_LIMITER.configure(args.max_rps)
+    RETRY_POLICY.configure(args.retries, args.retry_backoff)
+    SCOPE_OUTCOMES.configure(args.scope_outcomes)
+
+
+def print_profile(profiler):
+    print("Profile (wall time summed over worker threads):")
+    print(profiler.table())
+    dump_path = profiler.dump()
+    if dump_path:
+        print(f"pstats dump -> {dump_path}")
+
+
+def reset_transport_stats():
+    # print_transport_stats() reports one run; daemon.py calls this before
+    # each job since the pool and limiter outlive it.
+    HTTP_POOL.reset_stats()
+    RATE_LIMITER.throttled = 0
+
+
+def print_transport_stats():
+    stats = HTTP_POOL.stats()
+    print(f"Connections: opened {stats['opened']}, reused {stats['reused']}")
+    if RATE_LIMITER.throttled:
+        print(f"Rate limited (429): {RATE_LIMITER.throttled}")
+
+
+def explicit_location(args):
+    # --location-id/--company-id given on the command line. Values that only
+    # come from GHL_LOCATION_ID/GHL_COMPANY_ID are defaults that
+    # --location-ids overrides.
+    return any(
+        value and value != os.getenv(env)
+        for value, env in (
+            (args.location_id, "GHL_LOCATION_ID"),
+            (args.company_id, "GHL_COMPANY_ID"),
+        )
+    )
 
 
-def main():
-    args = parse_args()
+def main(argv=None):
+    args = parse_args(argv)
+    configure_transport(args)
 
     if not args.token and not args.dry_run:
         print("Missing API token. Set GHL_ACCESS_TOKEN or pass --token.")
         return 2
 
+    try:
+        location_ids = read_location_ids(args)
+    except OSError as exc:
+        print(f"Unable to read --location-ids-file: {exc}")
+        return 2
+    if location_ids and explicit_location(args):
+        print("Use either --location-id/--company-id or --location-ids.")
+        return 2
+
+    if args.list_users and location_ids:
+        if args.sync:
+            print("--sync works with a single --location-id.")
+            return 2
+        args.users_json, args.users_csv, args.users_diff = export_paths(args)
+        return list_locations(args, location_ids)
+
     if args.list_users:
         # Location ID and Company ID are the same thing
         location_id = args.location_id or args.company_id
         if not location_id:
             print("Provide --location-id or --company-id to list users.")
             return 2
+        args.users_json, args.users_csv, args.users_diff = export_paths(args)
 
         status, raw, users, total = fetch_all_users(args, location_id)
         if status != 200:
-            snippet = (raw or "").strip()
-            if len(snippet) > 500:
-                snippet = snippet[:500] + "..."
-            print(f"List users failed ({status}) -> {snippet}")
+            print(f"List users failed ({status}) -> {response_snippet(raw)}")
             return 1
 
-        write_users_json(args.users_json, users, location_id)
-        write_users_csv(args.users_csv, users)
-
         total_note = f" (total reported: {total})" if total is not None else ""
+        if args.sync:
+            diff, written = sync_users(args, users, location_id)
+            files = f"{args.users_json}, {args.users_csv}" if written else "unchanged"
+            print(
+                f"Users synced: {len(users)}{total_note}; {diff_summary(diff)} -> "
+                f"{args.users_diff} (snapshot {files})"
+            )
+            return 0
+
+        write_users_files(args, users, location_id)
         print(
             f"Users stored: {len(users)}{total_note} -> "
             f"{args.users_json}, {args.users_csv}"
@@ -492,8 +2796,55 @@ def main():
         print(f"CSV not found: {csv_path}")
         return 2
 
+    if location_ids and args.existing_users:
+        # A users export covers a single location.
+        print("--existing-users cannot be combined with --location-ids.")
+        return 2
+
+    if args.dry_run and not args.dry_run_report:
+        args.dry_run_report = (
+            DEFAULT_DRY_RUN_SUMMARY
+            if args.dry_run_format == "summary"
+            else DEFAULT_DRY_RUN_REPORT
+        )
+
+    args.existing = None
+    if args.skip_existing and not location_ids:
+        args.existing, error_msg = load_existing_users(args)
+        if error_msg:
+            print(error_msg)
+            return 2
+        print(f"Existing users indexed: {len(args.existing)}")
+
+    args.profiler = None
+    if args.profile or args.profile_out:
+        args.profiler = profiling.StageProfiler(args.profile_out)
+        args.profiler.start()
+
+    args.journal = None
+    if args.resume and (args.dry_run or args.no_journal):
+        print("--resume needs the journal; drop --dry-run/--no-journal.")
+        return 2
+    if not args.dry_run and not args.no_journal:
+        args.journal = ImportJournal(args.journal_path, csv_path, args.resume)
+        if args.resume:
+            print(f"Rows already created (journal): {len(args.journal.created)}")
+
+    try:
+        if location_ids:
+            return import_csv_locations(csv_path, args, location_ids)
+        return import_csv(csv_path, args)
+    finally:
+        if args.journal is not None:
+            args.journal.close()
+        if args.profiler is not None:
+            print_profile(args.profiler)
+
+
+def import_csv(csv_path, args):
     successes = 0
     failures = 0
+    skipped = 0
 
     with csv_path.open("r", encoding="utf-8-sig", newline="") as handle:
         reader = csv.DictReader(handle)
@@ -506,106 +2857,39 @@ def main():
             print("No recognized headers found in CSV.")
             return 2
 
-        for index, row in enumerate(reader, start=2):
-            normalized = normalize_row(row, mapping)
-            missing = [
-                field for field in REQUIRED_FIELDS if not normalized.get(field, "")
-            ]
-            if missing:
-                failures += 1
-                if row_failure(
-                    index, f"missing fields: {', '.join(sorted(missing))}", args
-                ):
-                    return 1
-                continue
-
-            role = normalize_role(normalized["role"])
-            if not role:
-                failures += 1
-                if row_failure(
-                    index,
-                    f"invalid role '{normalized['role']}'. Use Vendedor or Administrador.",
-                    args,
-                ):
-                    return 1
-                continue
-
-            try:
-                template = load_template(role)
-            except FileNotFoundError as exc:
-                print(str(exc))
-                return 2
-
-            location_ids = resolve_location_ids(args, template)
-            if not location_ids:
-                failures += 1
-                if row_failure(
-                    index, "missing locationIds in template or args.", args
-                ):
-                    return 1
-                continue
-
-            company_id = resolve_company_id(args, template, location_ids)
-            if not company_id:
-                failures += 1
-                if row_failure(index, "unable to resolve companyId.", args):
-                    return 1
-                continue
-
-            try:
-                body = build_body(template, normalized, company_id, location_ids)
-            except ValueError as exc:
-                failures += 1
-                if row_failure(index, str(exc), args):
-                    return 1
-                continue
-
-            if args.dry_run:
-                print(f"Row {index}: {role} -> {json.dumps(body, ensure_ascii=False)}")
-                successes += 1
-                continue
-
-            location_id = args.location_id or location_ids[0]
-
-            status, response_body = post_user(
-                args.base_url,
-                args.token,
-                args.api_version,
-                body,
-                args.timeout,
-                args.user_agent,
-                location_id,
-            )
-
-            if should_retry_without_scopes(status, body, response_body):
-                body_no_scopes = dict(body)
-                body_no_scopes.pop("scopes", None)
-                status, response_body = post_user(
-                    args.base_url,
-                    args.token,
-                    args.api_version,
-                    body_no_scopes,
-                    args.timeout,
-                    args.user_agent,
-                    location_id,
-                )
-
-            if status in (200, 201):
-                successes += 1
-                print(f"Row {index}: created ({status})")
-            else:
-                failures += 1
-                snippet = response_body.strip()
-                if len(snippet) > 500:
-                    snippet = snippet[:500] + "..."
-                print(f"Row {index}: failed ({status}) -> {snippet}")
-                if args.stop_on_error:
-                    return 1
-
-            if args.delay:
-                time.sleep(args.delay)
-
-    print(f"Done. Success: {successes}, Failed: {failures}")
+        report = open_dry_run_report(args)
+        results = iter_row_results(reader, mapping, args)
+        try:
+            for result in results:
+                with profiling.stage(args.profiler, "output"):
+                    if report is None:
+                        print_result(result)
+                    else:
+                        report.add(result)
+                if result.get("fatal"):
+                    if report is not None:
+                        report.close()
+                        print_result(result)
+                    return 2
+                if is_failure(result):
+                    failures += 1
+                    if args.stop_on_error:
+                        return 1
+                elif result["status"] == "skipped":
+                    skipped += 1
+                else:
+                    successes += 1
+        finally:
+            results.close()
+            if report is not None:
+                report.close()
+
+    if report is not None:
+        print_dry_run_report(report)
+    skipped_note = f", Skipped: {skipped}" if skipped else ""
+    print(f"Done. Success: {successes}, Failed: {failures}{skipped_note}")
+    if not args.dry_run:
+        print_transport_stats()
     return 0 if failures == 0 else 1
 
 
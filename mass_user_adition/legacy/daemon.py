@@ -0,0 +1,249 @@
+#!/usr/bin/env python3
+"""Long-lived import daemon for create_users.py and its thin client.
+
+The daemon keeps one interpreter with the templates, keep-alive connections,
+user listings and scope outcomes warm, and runs create_users.py jobs sent
+over a Unix socket. The client forwards its command line, working directory
+and GHL_* variables, prints the job's output as it arrives and exits with the
+job's exit code. Without a daemon listening, the client runs the import
+in-process, so the same command works either way.
+
+    python3 daemon.py serve
+    python3 daemon.py --csv usuarios.csv --location-id citQs4acsN1StzOEDuvj
+
+Jobs run one at a time, in arrival order: create_users.py configures the
+shared pool and rate limiter per run and resolves paths against the
+client's working directory. create_users is only imported by the daemon (or
+the in-process fallback) so the client starts fast.
+"""
+import argparse
+import io
+import json
+import os
+import signal
+import socket
+import socketserver
+import sys
+import threading
+from contextlib import redirect_stderr, redirect_stdout
+from pathlib import Path
+
+SOCKET_PATH_DEFAULT = Path(__file__).resolve().parent / ".cache" / "daemon.sock"
+SOCKET_ENV = "GHL_DAEMON_SOCKET"
+# Environment variables create_users.py reads its defaults from (token,
+# location, company, base URL...). Jobs see the client's values, not the
+# daemon's.
+JOB_ENV_PREFIX = "GHL_"
+# Keep idle connections longer than the CLI's 30s so they survive the gap
+# between jobs.
+POOL_IDLE_TIMEOUT_DEFAULT = 300.0
+
+
+def socket_path():
+    return os.environ.get(SOCKET_ENV) or str(SOCKET_PATH_DEFAULT)
+
+
+def send_message(sock, payload):
+    data = json.dumps(payload, ensure_ascii=False) + "\n"
+    sock.sendall(data.encode("utf-8"))
+
+
+def is_listening(path):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except OSError:
+        return False
+    finally:
+        sock.close()
+    return True
+
+
+def submit(argv, path):
+    # Client side. Returns the job's exit code, or None when no daemon
+    # answers at path.
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except (FileNotFoundError, ConnectionRefusedError):
+        sock.close()
+        return None
+
+    with sock:
+        env = job_env(os.environ)
+        send_message(sock, {"argv": argv, "cwd": os.getcwd(), "env": env})
+        try:
+            for line in sock.makefile("r", encoding="utf-8"):
+                message = json.loads(line)
+                if "out" in message:
+                    sys.stdout.write(message["out"])
+                    sys.stdout.flush()
+                if "exit" in message:
+                    return message["exit"]
+        except KeyboardInterrupt:
+            # Closing the socket stops the job after its current row.
+            return 130
+    print("Daemon closed the connection before the job finished.", file=sys.stderr)
+    return 1
+
+
+class SocketWriter(io.TextIOBase):
+    # A job's stdout and stderr: complete lines are sent to the client as
+    # {"out": ...} messages.
+
+    def __init__(self, sock):
+        self.sock = sock
+        self._pending = ""
+
+    def writable(self):
+        return True
+
+    def write(self, text):
+        self._pending += text
+        if "\n" in self._pending:
+            lines, _, self._pending = self._pending.rpartition("\n")
+            send_message(self.sock, {"out": lines + "\n"})
+        return len(text)
+
+    def flush(self):
+        if self._pending:
+            send_message(self.sock, {"out": self._pending})
+            self._pending = ""
+
+
+class JobHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        try:
+            job = json.loads(self.rfile.readline())
+        except ValueError:
+            send_message(self.connection, {"out": "Invalid job.\n", "exit": 2})
+            return
+        code = self.server.run_job(job, SocketWriter(self.connection))
+        try:
+            send_message(self.connection, {"exit": code})
+        except OSError:
+            pass
+
+
+class ImportDaemon(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path, job_defaults=()):
+        super().__init__(path, JobHandler)
+        self.job_defaults = list(job_defaults)
+        self.job_lock = threading.Lock()
+
+    def run_job(self, job, writer):
+        import create_users as cu
+
+        # Options given by the client come last and win over the defaults.
+        argv = self.job_defaults + [str(item) for item in job.get("argv") or []]
+        env = job.get("env") or {}
+        error = None
+        with self.job_lock:
+            cwd = os.getcwd()
+            saved_env = job_env(os.environ)
+            try:
+                os.chdir(job.get("cwd") or cwd)
+                set_job_env(env)
+                cu.reset_transport_stats()
+                with redirect_stdout(writer), redirect_stderr(writer):
+                    try:
+                        code = cu.main(argv)
+                    except SystemExit as exc:
+                        # argparse errors and --help.
+                        code = 0 if exc.code is None else exc.code
+                        if not isinstance(code, int):
+                            code = 2
+                    writer.flush()
+            except Exception as exc:
+                # Usually the client went away (Ctrl-C) mid-job; the journal
+                # has kept every row sent so far.
+                error, code = exc, 1
+            finally:
+                os.chdir(cwd)
+                set_job_env(saved_env)
+        if error is not None:
+            print(f"Job failed: {type(error).__name__}: {error}", file=sys.stderr)
+        return code
+
+
+def job_env(environ):
+    return {
+        key: value
+        for key, value in environ.items()
+        if key.startswith(JOB_ENV_PREFIX) and key != SOCKET_ENV
+    }
+
+
+def set_job_env(values):
+    for key in job_env(os.environ):
+        del os.environ[key]
+    for key, value in job_env(values).items():
+        os.environ[key] = str(value)
+
+
+def serve(argv):
+    import create_users as cu
+
+    parser = argparse.ArgumentParser(
+        prog="daemon.py serve", description="Run the import daemon."
+    )
+    parser.add_argument("--socket", default=socket_path(), help="Unix socket path")
+    parser.add_argument(
+        "--pool-idle-timeout",
+        type=float,
+        default=POOL_IDLE_TIMEOUT_DEFAULT,
+        help="Default --pool-idle-timeout for jobs",
+    )
+    args = parser.parse_args(argv)
+
+    path = Path(args.socket)
+    if is_listening(str(path)):
+        print(f"A daemon is already listening on {path}")
+        return 2
+    path.parent.mkdir(parents=True, exist_ok=True)
+    try:
+        path.unlink()
+    except FileNotFoundError:
+        pass
+
+    daemon = ImportDaemon(
+        str(path), ["--pool-idle-timeout", str(args.pool_idle_timeout)]
+    )
+    os.chmod(path, 0o600)
+    signal.signal(
+        signal.SIGTERM,
+        lambda *_: threading.Thread(target=daemon.shutdown, daemon=True).start(),
+    )
+    print(f"Import daemon listening on {path}")
+    try:
+        daemon.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        daemon.server_close()
+        cu.HTTP_POOL.close()
+        try:
+            path.unlink()
+        except FileNotFoundError:
+            pass
+    return 0
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if argv[:1] == ["serve"]:
+        return serve(argv[1:])
+
+    code = submit(argv, socket_path())
+    if code is None:
+        print(f"No daemon at {socket_path()}; running in-process.", file=sys.stderr)
+        import create_users
+
+        code = create_users.main(argv)
+    return code
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+"""Prometheus-style metrics for create_users.py and server.py.
+
+Counters, gauges and histograms keep their values in a dict keyed by label
+values behind one lock per metric, so recording on the per-row path is a
+single dict update. render() returns the text exposition format served by
+server.py on /metrics.
+"""
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+# Upper bounds in seconds; GHL calls usually take 100ms-2s.
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+DURATION_BUCKETS = (0.1, 0.5, 1.0, 5.0, 15.0, 60.0, 300.0, 900.0, 3600.0)
+
+REGISTRY = []
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value):
+    if value == int(value):
+        return str(int(value))
+    return repr(float(value))
+
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def _label_text(self, values, extra=()):
+        pairs = list(zip(self.labels, values)) + list(extra)
+        if not pairs:
+            return ""
+        inner = ",".join(f'{key}="{_escape(value)}"' for key, value in pairs)
+        return "{" + inner + "}"
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self.samples())
+        return lines
+
+    def samples(self):
+        with self._lock:
+            items = sorted(self._values.items())
+        for values, value in items:
+            label_text = self._label_text(values)
+            yield f"{self.name}{label_text} {_format_value(value)}"
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, *values, amount=1):
+        with self._lock:
+            self._values[values] = self._values.get(values, 0) + amount
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def __init__(self, name, help, labels=(), func=None):
+        super().__init__(name, help, labels)
+        # func, when set, is called at scrape time for an unlabeled value.
+        self.func = func
+
+    def inc(self, *values, amount=1):
+        with self._lock:
+            self._values[values] = self._values.get(values, 0) + amount
+
+    def dec(self, *values, amount=1):
+        self.inc(*values, amount=-amount)
+
+    def set(self, value, *values):
+        with self._lock:
+            self._values[values] = value
+
+    @contextmanager
+    def track(self, *values):
+        self.inc(*values)
+        try:
+            yield
+        finally:
+            self.dec(*values)
+
+    def samples(self):
+        if self.func is not None:
+            yield f"{self.name} {_format_value(self.func())}"
+            return
+        yield from super().samples()
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *values):
+        # Per-bucket counts are stored non-cumulative and summed at scrape.
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(values)
+            if entry is None:
+                entry = self._values[values] = [[0] * (len(self.buckets) + 1), 0.0]
+            entry[0][index] += 1
+            entry[1] += value
+
+    @contextmanager
+    def time(self, *values):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, *values)
+
+    def samples(self):
+        with self._lock:
+            items = sorted(
+                (values, (list(counts), total))
+                for values, (counts, total) in self._values.items()
+            )
+        for values, (counts, total) in items:
+            cumulative = 0
+            bounds = [repr(float(bound)) for bound in self.buckets] + ["+Inf"]
+            for bound, count in zip(bounds, counts):
+                cumulative += count
+                label_text = self._label_text(values, [("le", bound)])
+                yield f"{self.name}_bucket{label_text} {cumulative}"
+            label_text = self._label_text(values)
+            yield f"{self.name}_sum{label_text} {_format_value(total)}"
+            yield f"{self.name}_count{label_text} {cumulative}"
+
+
+def render():
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+UPSTREAM_LATENCY = Histogram(
+    "ghl_upstream_request_duration_seconds",
+    "Duration of each HTTP exchange with the GHL API.",
+    ("method", "endpoint", "status"),
+)
+UPSTREAM_IN_FLIGHT = Gauge(
+    "ghl_upstream_requests_in_flight",
+    "HTTP exchanges with the GHL API currently waiting for a response.",
+)
+ROWS_PROCESSED = Counter(
+    "ghl_rows_processed_total",
+    "CSV rows processed by outcome.",
+    ("outcome",),
+)
+SCOPE_RETRIES = Counter(
+    "ghl_scope_retries_total",
+    "Rows sent without scopes: after a 422 (rejected) or up front (learned).",
+    ("reason",),
+)
+IMPORT_DURATION = Histogram(
+    "ghl_import_duration_seconds",
+    "Duration of CSV imports handled by the server.",
+    ("mode",),
+    buckets=DURATION_BUCKETS,
+)
+LIST_DURATION = Histogram(
+    "ghl_list_duration_seconds",
+    "Duration of /list requests by result.",
+    ("result",),
+)
+HTTP_RESPONSES = Counter(
+    "ghl_http_responses_total",
+    "Responses sent by server.py by method, path and status code.",
+    ("method", "path", "code"),
+)
+HTTP_IN_FLIGHT = Gauge(
+    "ghl_http_requests_in_flight",
+    "Requests server.py is currently handling.",
+)
+JOB_QUEUE_DEPTH = Gauge(
+    "ghl_job_queue_depth",
+    "Background import jobs waiting for a worker.",
+    func=lambda: 0,
+)
@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+"""Per-stage timing for create_users.py --profile and the /run profile option.
+
+A StageProfiler adds up wall time (perf_counter) and CPU time (thread_time,
+the calling thread only) for each named stage of an import: reading the CSV,
+normalizing rows, building bodies from templates, JSON encoding, waiting on
+the rate limiter, the HTTP round trip and so on. Stages run in every worker
+thread, so with --workers > 1 their wall times add up to more than the run's
+elapsed time. With dump_path set, the run is also recorded with cProfile and
+saved as a pstats file.
+"""
+import cProfile
+import pstats
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+
+_NULL = nullcontext()
+
+
+class StageProfiler:
+    def __init__(self, dump_path=None):
+        self.dump_path = dump_path
+        self.started = time.perf_counter()
+        self.cpu_started = time.process_time()
+        self.stages = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._profiles = []
+        self._main = None
+
+    def add(self, name, wall, cpu):
+        with self._lock:
+            entry = self.stages.get(name)
+            if entry is None:
+                entry = self.stages[name] = [0, 0.0, 0.0]
+            entry[0] += 1
+            entry[1] += wall
+            entry[2] += cpu
+
+    @contextmanager
+    def stage(self, name):
+        wall = time.perf_counter()
+        cpu = time.thread_time()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - wall, time.thread_time() - cpu)
+
+    def iterate(self, name, iterable):
+        # Times each next() on iterable, e.g. csv.DictReader parsing a row.
+        iterator = iter(iterable)
+        while True:
+            with self.stage(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def start(self):
+        # cProfile only follows the thread that enables it; worker threads are
+        # recorded through call().
+        if self.dump_path and self._main is None:
+            self._main = cProfile.Profile()
+            self._main.enable()
+
+    def call(self, func, *args):
+        # Runs func in a worker thread under that thread's own cProfile.
+        if not self.dump_path:
+            return func(*args)
+        profile = getattr(self._local, "profile", None)
+        if profile is None:
+            profile = self._local.profile = cProfile.Profile()
+            with self._lock:
+                self._profiles.append(profile)
+        try:
+            return profile.runcall(func, *args)
+        except ValueError:
+            # Python 3.12+ has one process-wide profiler: the main one already
+            # sees this thread.
+            return func(*args)
+
+    def dump(self):
+        if not self.dump_path:
+            return None
+        if self._main is not None:
+            self._main.disable()
+        profiles = [self._main] if self._main is not None else []
+        profiles.extend(profile for profile in self._profiles if profile.getstats())
+        if not profiles:
+            return None
+        pstats.Stats(*profiles).dump_stats(self.dump_path)
+        return self.dump_path
+
+    def report(self):
+        # JSON-friendly breakdown, slowest stage first.
+        elapsed = time.perf_counter() - self.started
+        with self._lock:
+            items = sorted(self.stages.items(), key=lambda item: -item[1][1])
+        return {
+            "elapsed": round(elapsed, 4),
+            "processCpu": round(time.process_time() - self.cpu_started, 4),
+            "stages": [
+                {
+                    "stage": name,
+                    "calls": calls,
+                    "wall": round(wall, 4),
+                    "cpu": round(cpu, 4),
+                    "wallPerCall": round(wall / calls, 6) if calls else 0.0,
+                }
+                for name, (calls, wall, cpu) in items
+            ],
+        }
+
+    def table(self):
+        report = self.report()
+        elapsed = report["elapsed"] or 1e-9
+        lines = [
+            f"{'Stage':<12} {'Calls':>8} {'Wall s':>9} {'% run':>7} "
+            f"{'CPU s':>9} {'ms/call':>9}"
+        ]
+        for item in report["stages"]:
+            lines.append(
+                f"{item['stage']:<12} {item['calls']:>8} {item['wall']:>9.3f} "
+                f"{item['wall'] / elapsed * 100:>6.1f}% {item['cpu']:>9.3f} "
+                f"{item['wallPerCall'] * 1000:>9.3f}"
+            )
+        cpu = report["processCpu"]
+        lines.append(f"Elapsed {report['elapsed']:.3f}s, process CPU {cpu:.3f}s")
+        return "\n".join(lines)
+
+
+def stage(profiler, name):
+    # Context manager for call sites where profiling is optional.
+    if profiler is None:
+        return _NULL
+    return profiler.stage(name)
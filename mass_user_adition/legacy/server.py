@@ -1,20 +1,121 @@
 #!/usr/bin/env python3
+import argparse
 import csv
 import io
+import itertools
 import json
+import os
+import queue
+import threading
 import time
-from http.server import BaseHTTPRequestHandler, HTTPServer
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from pathlib import Path
 from types import SimpleNamespace
+from urllib import parse
 
 import create_users as cu
+import metrics
+import profiling
 
 BASE_DIR = Path(__file__).resolve().parent
+HOST_DEFAULT = "127.0.0.1"
+PORT_DEFAULT = 8080
+MAX_JOBS_DEFAULT = 2
+MAX_LISTS_DEFAULT = 2
+JOBS_DIR_DEFAULT = BASE_DIR / "jobs"
+RESULTS_PAGE_DEFAULT = 100
+RESULTS_PAGE_MAX = 1000
+SPOOL_CHUNK_SIZE = 64 * 1024
+# Seconds a client is told to wait when every job slot is busy.
+BUSY_RETRY_AFTER = 5
+# Seconds between progress events in streaming /run responses.
+PROGRESS_INTERVAL = 1.0
+STREAM_TYPES = {
+    "ndjson": "application/x-ndjson; charset=utf-8",
+    "sse": "text/event-stream; charset=utf-8",
+}
 INDEX_PATH = BASE_DIR / "web" / "index.html"
+METRICS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+# Paths reported in ghl_http_responses_total; anything else is "other".
+METRIC_PATHS = {"/", "/index.html", "/run", "/list", "/jobs", "/metrics"}
+
+
+# Options accepted by /run and /list. For a raw text/csv upload they come from
+# the query string or from "X-<option>" headers instead of the JSON payload.
+RUN_OPTIONS = (
+    "baseUrl",
+    "apiVersion",
+    "locationId",
+    "companyId",
+    "delay",
+    "timeout",
+    "rowDeadline",
+    "dryRun",
+    "workers",
+    "stream",
+    "wait",
+    "skipExisting",
+    "profile",
+)
+
+
+def parse_bool(value):
+    if isinstance(value, str):
+        return value.strip().lower() in ("1", "true", "yes", "on")
+    return bool(value)
+
+
+class RequestBody(io.RawIOBase):
+    # Request body as a readable stream. Stops at Content-Length or decodes
+    # chunked transfer encoding, returning data as soon as it arrives so rows
+    # can be parsed while the upload is still in progress.
+
+    def __init__(self, rfile, length=None, chunked=False):
+        self.rfile = rfile
+        self.remaining = length or 0
+        self.chunked = chunked
+        self.done = not chunked and not length
+        self.length = length
+        self.consumed = 0
+
+    def readable(self):
+        return True
+
+    def _next_chunk(self):
+        size_line = self.rfile.readline()
+        size = int(size_line.split(b";")[0].strip() or b"0", 16)
+        if size == 0:
+            while self.rfile.readline() not in (b"\r\n", b"\n", b""):
+                pass
+            self.done = True
+        self.remaining = size
+
+    def readinto(self, buffer):
+        if self.done:
+            return 0
+        if self.chunked and self.remaining == 0:
+            self._next_chunk()
+            if self.done:
+                return 0
+        data = self.rfile.read1(min(len(buffer), self.remaining))
+        if not data:
+            self.done = True
+            return 0
+        size = len(data)
+        buffer[:size] = data
+        self.remaining -= size
+        self.consumed += size
+        if self.remaining == 0:
+            if self.chunked:
+                self.rfile.readline()
+            else:
+                self.done = True
+        return size
 
 
 def build_args(payload):
-    return SimpleNamespace(
+    args = SimpleNamespace(
         base_url=payload.get("baseUrl") or cu.BASE_URL_DEFAULT,
         api_version=payload.get("apiVersion") or cu.API_VERSION_DEFAULT,
         user_agent=cu.USER_AGENT_DEFAULT,
@@ -23,207 +124,440 @@ def build_args(payload):
         company_id=(payload.get("companyId") or "").strip() or None,
         delay=float(payload.get("delay") or 0),
         timeout=float(payload.get("timeout") or 30.0),
-        dry_run=bool(payload.get("dryRun")),
+        row_deadline=float(payload.get("rowDeadline") or cu.ROW_DEADLINE_DEFAULT),
+        dry_run=parse_bool(payload.get("dryRun")),
         stop_on_error=False,
+        workers=max(1, int(payload.get("workers") or 1)),
+        skip_existing=parse_bool(payload.get("skipExisting")),
+        existing=None,
         list_limit=int(payload.get("listLimit") or 100),
+        cache_ttl=float(payload.get("cacheTtl", cu.USERS_CACHE_TTL_DEFAULT)),
+        refresh=parse_bool(payload.get("refresh")),
         users_json=(payload.get("usersJson") or cu.DEFAULT_USERS_JSON),
         users_csv=(payload.get("usersCsv") or cu.DEFAULT_USERS_CSV),
+        users_diff=(payload.get("usersDiff") or cu.DEFAULT_USERS_DIFF),
+        locations_summary=(
+            payload.get("locationsSummary") or cu.DEFAULT_LOCATIONS_SUMMARY
+        ),
+        users_format=payload.get("usersFormat") or "json",
+        gzip=parse_bool(payload.get("gzip")),
+        profiler=(
+            profiling.StageProfiler() if parse_bool(payload.get("profile")) else None
+        ),
     )
-
-
-def process_csv(csv_text, args):
-    reader = csv.DictReader(io.StringIO(csv_text))
+    args.users_json, args.users_csv, args.users_diff = cu.export_paths(args)
+    return args
+
+
+def format_result(result):
+    status = result["status"]
+    if status == "created":
+        formatted = {"row": result["row"], "status": "created"}
+    elif status == "failed":
+        formatted = {
+            "row": result["row"],
+            "status": f"failed ({result['code']})",
+            "message": result["message"],
+        }
+    else:
+        formatted = None
+    if formatted is not None:
+        if result.get("retries"):
+            formatted["retries"] = result["retries"]
+        if "elapsed" in result:
+            formatted["elapsed"] = result["elapsed"]
+        return formatted
+    if status == "dry-run":
+        return {
+            "row": result["row"],
+            "status": "dry-run",
+            "body": cu.encode_body(result["body"]).decode("utf-8"),
+        }
+    formatted = {"row": result["row"], "status": status}
+    if result.get("message"):
+        formatted["message"] = result["message"]
+    return formatted
+
+
+def open_csv(source, args):
+    # source is the CSV text or a text stream (e.g. a streaming upload).
+    if isinstance(source, str):
+        source = io.StringIO(source)
+    reader = csv.DictReader(source)
     if not reader.fieldnames:
-        return None, "CSV has no headers."
+        return None, None, "CSV has no headers."
 
     mapping = cu.resolve_headers(reader.fieldnames)
     if not mapping:
-        return None, "No recognized headers found in CSV."
-
-    results = []
-    successes = 0
-    failures = 0
-
-    for index, row in enumerate(reader, start=2):
-        normalized = cu.normalize_row(row, mapping)
-        missing = [
-            field
-            for field in cu.REQUIRED_FIELDS
-            if not normalized.get(field, "")
-        ]
-        if missing:
-            failures += 1
-            results.append(
-                {
-                    "row": index,
-                    "status": "error",
-                    "message": f"missing fields: {', '.join(sorted(missing))}",
-                }
-            )
-            continue
-
-        role = cu.normalize_role(normalized.get("role", ""))
-        if not role:
-            failures += 1
-            results.append(
-                {
-                    "row": index,
-                    "status": "error",
-                    "message": f"invalid role '{normalized.get('role', '')}'",
-                }
-            )
-            continue
+        return None, None, "No recognized headers found in CSV."
 
-        try:
-            template = cu.load_template(role)
-        except FileNotFoundError as exc:
-            failures += 1
-            results.append({"row": index, "status": "error", "message": str(exc)})
-            continue
-
-        location_ids = cu.resolve_location_ids(args, template)
-        if not location_ids:
-            failures += 1
-            results.append(
-                {
-                    "row": index,
-                    "status": "error",
-                    "message": "missing locationIds in template or args",
-                }
-            )
-            continue
-
-        company_id = cu.resolve_company_id(args, template, location_ids)
-        if not company_id:
-            failures += 1
-            results.append(
-                {
-                    "row": index,
-                    "status": "error",
-                    "message": "unable to resolve companyId",
-                }
-            )
-            continue
+    if args.skip_existing and args.existing is None:
+        args.existing, error_msg = cu.load_existing_users(args)
+        if error_msg:
+            return None, None, error_msg
+    return reader, mapping, None
+
+
+def progress_summary(counts, started, fraction=None):
+    processed = sum(counts.values())
+    elapsed = time.monotonic() - started
+    rate = processed / elapsed if elapsed > 0 else 0.0
+    eta = None
+    if fraction:
+        eta = round(elapsed * (1 - fraction) / fraction, 1)
+    return {
+        "processed": processed,
+        "success": counts["success"],
+        "failed": counts["failed"],
+        "skipped": counts["skipped"],
+        "elapsed": round(elapsed, 3),
+        "rowsPerSecond": round(rate, 2),
+        "eta": eta,
+    }
+
+
+def iter_csv_events(reader, mapping, args, progress=None, mode="inline"):
+    # Yields ("row", result), periodic ("progress", summary) and a final
+    # ("summary", summary). progress, when given, maps the number of rows
+    # processed to the fraction of the input done and is used for the ETA.
+    # mode labels the import in ghl_import_duration_seconds.
+    started = time.monotonic()
+    next_progress = started + PROGRESS_INTERVAL
+    counts = {"success": 0, "failed": 0, "skipped": 0}
+    rows_processed = metrics.ROWS_PROCESSED
+
+    for result in cu.iter_row_results(reader, mapping, args):
+        rows_processed.inc(result["status"])
+        if cu.is_failure(result):
+            counts["failed"] += 1
+        elif result["status"] == "skipped":
+            counts["skipped"] += 1
+        else:
+            counts["success"] += 1
+        yield "row", format_result(result)
 
-        try:
-            body = cu.build_body(template, normalized, company_id, location_ids)
-        except ValueError as exc:
-            failures += 1
-            results.append({"row": index, "status": "error", "message": str(exc)})
-            continue
-
-        if args.dry_run:
-            successes += 1
-            results.append(
-                {
-                    "row": index,
-                    "status": "dry-run",
-                    "body": json.dumps(body, ensure_ascii=False),
-                }
-            )
-            continue
-
-        location_id = args.location_id or location_ids[0]
-        status, response_body = cu.post_user(
-            args.base_url,
-            args.token,
-            args.api_version,
-            body,
-            args.timeout,
-            args.user_agent,
-            location_id,
-        )
+        now = time.monotonic()
+        if now >= next_progress:
+            next_progress = now + PROGRESS_INTERVAL
+            fraction = progress(sum(counts.values())) if progress else None
+            yield "progress", progress_summary(counts, started, fraction)
 
-        if cu.should_retry_without_scopes(status, body, response_body):
-            body_no_scopes = dict(body)
-            body_no_scopes.pop("scopes", None)
-            status, response_body = cu.post_user(
-                args.base_url,
-                args.token,
-                args.api_version,
-                body_no_scopes,
-                args.timeout,
-                args.user_agent,
-                location_id,
-            )
+    summary = progress_summary(counts, started)
+    summary["eta"] = 0
+    summary["connections"] = cu.HTTP_POOL.stats()
+    if args.profiler is not None:
+        summary["profile"] = args.profiler.report()
+    metrics.IMPORT_DURATION.observe(time.monotonic() - started, mode)
+    yield "summary", summary
 
-        if status in (200, 201):
-            successes += 1
-            results.append({"row": index, "status": "created"})
-        else:
-            failures += 1
-            snippet = (response_body or "").strip()
-            if len(snippet) > 500:
-                snippet = snippet[:500] + "..."
-            results.append(
-                {
-                    "row": index,
-                    "status": f"failed ({status})",
-                    "message": snippet,
-                }
-            )
 
-        if args.delay:
-            time.sleep(args.delay)
+def process_csv(source, args):
+    reader, mapping, error_msg = open_csv(source, args)
+    if error_msg:
+        return None, error_msg
 
-    summary = {"success": successes, "failed": failures}
+    results = []
+    summary = None
+    for kind, data in iter_csv_events(reader, mapping, args):
+        if kind == "row":
+            results.append(data)
+        elif kind == "summary":
+            summary = data
+
+    keys = ("success", "failed", "skipped", "connections", "profile")
+    summary = {key: summary[key] for key in keys if key in summary}
     return {"summary": summary, "results": results}, None
 
 
+def encode_event(mode, kind, data):
+    if mode == "sse":
+        payload = json.dumps(data, ensure_ascii=False)
+        return f"event: {kind}\ndata: {payload}\n\n".encode("utf-8")
+    line = dict(data, type=kind)
+    return (json.dumps(line, ensure_ascii=False) + "\n").encode("utf-8")
+
+
 def summarize_users(users):
-    summarized = []
-    for user in users:
-        roles = user.get("roles") or {}
-        summarized.append(
-            {
-                "id": user.get("id", ""),
-                "name": user.get("name", ""),
-                "firstName": user.get("firstName", ""),
-                "lastName": user.get("lastName", ""),
-                "email": user.get("email", ""),
-                "phone": user.get("phone", ""),
-                "role": roles.get("role", ""),
-                "type": roles.get("type", ""),
-                "locationIds": roles.get("locationIds") or [],
-                "deleted": user.get("deleted", False),
-                "dateAdded": user.get("dateAdded", ""),
-                "dateUpdated": user.get("dateUpdated", ""),
-            }
-        )
-    return summarized
+    return [user.summary() for user in users]
+
+
+def parse_location_ids(value):
+    # locationIds may be a JSON list or a comma/newline separated string.
+    if isinstance(value, str):
+        value = value.replace("\n", ",").split(",")
+    return list(dict.fromkeys(str(item).strip() for item in value or () if item))
+
+
+def process_list_locations(payload, args, location_ids):
+    users, summaries = cu.fetch_locations_users(
+        args, location_ids, int(payload.get("locationWorkers") or 4)
+    )
+    files = {"json": args.users_json, "csv": args.users_csv}
+    if payload.get("saveFiles", True):
+        cu.write_users_files(args, users, None, location_ids)
+        cu.write_locations_summary(args.locations_summary, summaries)
+        files["locations"] = args.locations_summary
+
+    failed = sum(1 for summary in summaries if summary["status"] != 200)
+    return (
+        {
+            "summary": {
+                "count": len(users),
+                "locations": len(location_ids),
+                "failedLocations": failed,
+            },
+            "files": files,
+            "locations": summaries,
+            "users": summarize_users(users),
+        },
+        None,
+    )
 
 
 def process_list(payload, args):
+    started = time.perf_counter()
+    data, error_msg = list_users(payload, args)
+    metrics.LIST_DURATION.observe(
+        time.perf_counter() - started, "error" if error_msg else "ok"
+    )
+    return data, error_msg
+
+
+def list_users(payload, args):
     # Location ID and Company ID are the same thing
     location_id = args.location_id or args.company_id
+    location_ids = parse_location_ids(payload.get("locationIds"))
 
-    if not location_id:
+    if not location_id and not location_ids:
         return None, "Informe Location ID ou Company ID."
+    if args.users_format not in cu.USERS_FORMATS:
+        return None, f"usersFormat invalido: {args.users_format}"
+    if location_ids:
+        if parse_bool(payload.get("sync")):
+            return None, "sync funciona com uma unica location."
+        return process_list_locations(payload, args, location_ids)
 
     status, raw, users, total = cu.fetch_all_users(args, location_id)
     if status != 200:
-        snippet = (raw or "").strip()
-        if len(snippet) > 500:
-            snippet = snippet[:500] + "..."
-        return None, f"Falha ao listar ({status}) -> {snippet}"
-
-    if payload.get("saveFiles", True):
-        cu.write_users_json(args.users_json, users, location_id)
-        cu.write_users_csv(args.users_csv, users)
+        return None, f"Falha ao listar ({status}) -> {cu.response_snippet(raw)}"
+
+    files = {"json": args.users_json, "csv": args.users_csv}
+    summary = {"count": len(users), "total": total}
+    if parse_bool(payload.get("sync")):
+        diff, written = cu.sync_users(args, users, location_id)
+        files["diff"] = args.users_diff
+        summary.update({key: len(value) for key, value in diff.items()})
+        summary["snapshotWritten"] = written
+    elif payload.get("saveFiles", True):
+        cu.write_users_files(args, users, location_id)
 
     return (
         {
-            "summary": {"count": len(users), "total": total},
-            "files": {"json": args.users_json, "csv": args.users_csv},
+            "summary": summary,
+            "files": files,
             "users": summarize_users(users),
         },
         None,
     )
 
 
+def utc_now():
+    return time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
+
+
+def count_lines(path):
+    count = 0
+    with open(path, "rb") as handle:
+        for chunk in iter(lambda: handle.read(SPOOL_CHUNK_SIZE), b""):
+            count += chunk.count(b"\n")
+    return count
+
+
+class JobQueue:
+    # Bulk imports executed by background workers. Each job keeps its state in
+    # the jobs directory: <id>.json (status and counters), <id>.csv (spooled
+    # input, removed when the job ends) and <id>.ndjson (one row result per
+    # line), so finished jobs and their results survive a server restart.
+
+    def __init__(self, directory, workers, slots):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.slots = slots
+        self.jobs = {}
+        self.lock = threading.Lock()
+        self.pending = queue.Queue()
+        self._load()
+        for _ in range(max(1, workers)):
+            threading.Thread(target=self._worker, daemon=True).start()
+
+    def path(self, job_id, suffix):
+        return self.directory / f"{job_id}{suffix}"
+
+    def _save(self, job):
+        path = self.path(job["id"], ".json")
+        tmp = path.with_suffix(".json.tmp")
+        with tmp.open("w", encoding="utf-8") as handle:
+            json.dump(job, handle, ensure_ascii=False)
+        os.replace(tmp, path)
+
+    def _load(self):
+        for path in sorted(self.directory.glob("*.json")):
+            try:
+                with path.open("r", encoding="utf-8") as handle:
+                    job = json.load(handle)
+            except (OSError, json.JSONDecodeError):
+                continue
+            if job.get("status") == "queued" and self.path(job["id"], ".csv").exists():
+                self.pending.put(job["id"])
+            elif job.get("status") in ("queued", "running"):
+                job["status"] = "interrupted"
+                job["finishedAt"] = utc_now()
+                self._save(job)
+            self.jobs[job["id"]] = job
+
+    def submit(self, options, write_input):
+        # write_input(path) spools the CSV to disk before the job is queued.
+        job_id = uuid.uuid4().hex[:16]
+        write_input(self.path(job_id, ".csv"))
+        job = {
+            "id": job_id,
+            "status": "queued",
+            "createdAt": utc_now(),
+            "options": options,
+            "processed": 0,
+            "progress": None,
+            "summary": None,
+            "error": None,
+        }
+        with self.lock:
+            self.jobs[job_id] = job
+            self._save(job)
+        self.pending.put(job_id)
+        return self.get(job_id)
+
+    def get(self, job_id):
+        with self.lock:
+            job = self.jobs.get(job_id)
+            return json.loads(json.dumps(job)) if job else None
+
+    def queue_depth(self):
+        return self.pending.qsize()
+
+    def results(self, job_id, offset, limit):
+        path = self.path(job_id, ".ndjson")
+        if not path.exists():
+            return []
+        results = []
+        with path.open("r", encoding="utf-8") as handle:
+            for line in itertools.islice(handle, offset, offset + limit):
+                if not line.endswith("\n"):
+                    break
+                results.append(json.loads(line))
+        return results
+
+    def _update(self, job, **changes):
+        with self.lock:
+            job.update(changes)
+            self._save(job)
+
+    def _worker(self):
+        while True:
+            job_id = self.pending.get()
+            with self.slots:
+                try:
+                    self._run(self.jobs[job_id])
+                except Exception as exc:
+                    # _run records its own failures; this only keeps the worker
+                    # alive when saving the job state fails too.
+                    with self.lock:
+                        job = self.jobs.get(job_id)
+                        if job is not None:
+                            job.update(
+                                status="failed", error=str(exc), finishedAt=utc_now()
+                            )
+
+    def _run(self, job):
+        input_path = self.path(job["id"], ".csv")
+        self._update(job, status="running", startedAt=utc_now())
+        try:
+            args = build_args(job["options"])
+            total = max(1, count_lines(input_path) - 1)
+
+            def progress(processed):
+                return min(1.0, processed / total)
+
+            with input_path.open(
+                "r", encoding="utf-8-sig", newline=""
+            ) as handle, self.path(job["id"], ".ndjson").open(
+                "a", encoding="utf-8"
+            ) as out:
+                reader, mapping, error_msg = open_csv(handle, args)
+                if error_msg:
+                    self._update(job, status="failed", error=error_msg)
+                    return
+                events = iter_csv_events(reader, mapping, args, progress, "job")
+                for kind, data in events:
+                    if kind == "row":
+                        out.write(json.dumps(data, ensure_ascii=False) + "\n")
+                        out.flush()
+                        with self.lock:
+                            job["processed"] += 1
+                    elif kind == "progress":
+                        self._update(job, progress=data)
+                    else:
+                        self._update(job, summary=data)
+            self._update(job, status="done")
+        except Exception as exc:
+            self._update(job, status="failed", error=str(exc))
+        finally:
+            self._update(job, finishedAt=utc_now())
+            try:
+                input_path.unlink()
+            except FileNotFoundError:
+                pass
+
+
 class Handler(BaseHTTPRequestHandler):
+    # Limits concurrent imports (queued or inline /run) and, separately,
+    # concurrent /list calls, so running imports never lock out /list. Set by
+    # main() from --max-jobs and --max-lists.
+    job_slots = threading.BoundedSemaphore(MAX_JOBS_DEFAULT)
+    list_slots = threading.BoundedSemaphore(MAX_LISTS_DEFAULT)
+    jobs = None
+
     def do_GET(self):
-        if self.path in ("/", "/index.html"):
+        with metrics.HTTP_IN_FLIGHT.track():
+            self.handle_get()
+
+    def do_POST(self):
+        with metrics.HTTP_IN_FLIGHT.track():
+            self.handle_post()
+
+    def send_response(self, code, message=None):
+        url_path = parse.urlsplit(getattr(self, "path", "")).path
+        if url_path.startswith("/jobs/"):
+            url_path = "/jobs"
+        if url_path not in METRIC_PATHS:
+            url_path = "other"
+        method = getattr(self, "command", None) or ""
+        metrics.HTTP_RESPONSES.inc(method, url_path, str(code))
+        super().send_response(code, message)
+
+    def handle_get(self):
+        url = parse.urlsplit(self.path)
+        parts = url.path.strip("/").split("/")
+        if parts[0] == "jobs" and len(parts) in (2, 3):
+            self.get_job(parts[1], parts[2] if len(parts) == 3 else None, url.query)
+            return
+        if url.path == "/metrics":
+            content = metrics.render().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", METRICS_CONTENT_TYPE)
+            self.send_header("Content-Length", str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+            return
+        if url.path in ("/", "/index.html"):
             if not INDEX_PATH.exists():
                 self.send_error(404, "index.html not found")
                 return
@@ -236,55 +570,287 @@ class Handler(BaseHTTPRequestHandler):
             return
         self.send_error(404, "Not Found")
 
-    def do_POST(self):
-        if self.path not in ("/run", "/list"):
+    def send_json(self, status, data):
+        response = json.dumps(data, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+    def request_body(self):
+        chunked = "chunked" in self.headers.get("Transfer-Encoding", "").lower()
+        length = int(self.headers.get("Content-Length", "0") or 0)
+        return RequestBody(self.rfile, length=length, chunked=chunked)
+
+    def upload_options(self, query):
+        params = parse.parse_qs(query)
+        options = {}
+        for key in RUN_OPTIONS:
+            if key in params:
+                options[key] = params[key][-1]
+            elif self.headers.get(f"X-{key}") is not None:
+                options[key] = self.headers.get(f"X-{key}")
+        return options
+
+    def stream_mode(self, options):
+        mode = (options.get("stream") or "").strip().lower()
+        if mode in STREAM_TYPES:
+            return mode
+        accept = self.headers.get("Accept", "")
+        if "application/x-ndjson" in accept:
+            return "ndjson"
+        if "text/event-stream" in accept:
+            return "sse"
+        return None
+
+    def stream_csv(self, mode, source, args, progress=None):
+        # Sends each row result as soon as it is ready; nothing is buffered,
+        # so memory stays flat regardless of the batch size.
+        reader, mapping, error_msg = open_csv(source, args)
+        if error_msg:
+            self.send_json(400, {"error": error_msg})
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", STREAM_TYPES[mode])
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+        try:
+            events = iter_csv_events(reader, mapping, args, progress, "stream")
+            for kind, data in events:
+                self.wfile.write(encode_event(mode, kind, data))
+                self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            return
+        except Exception as exc:
+            self.wfile.write(encode_event(mode, "error", {"message": str(exc)}))
+
+    def get_job(self, job_id, view, query):
+        job = self.jobs.get(job_id) if self.jobs else None
+        if job is None or view not in (None, "results"):
+            self.send_json(404, {"error": "Job not found."})
+            return
+        if view is None:
+            self.send_json(200, job)
+            return
+
+        params = parse.parse_qs(query)
+        try:
+            offset = max(0, int(params.get("offset", ["0"])[-1]))
+            limit = int(params.get("limit", [str(RESULTS_PAGE_DEFAULT)])[-1])
+        except ValueError:
+            self.send_json(400, {"error": "offset/limit must be integers."})
+            return
+        limit = min(max(1, limit), RESULTS_PAGE_MAX)
+        results = self.jobs.results(job_id, offset, limit)
+        self.send_json(
+            200,
+            {
+                "jobId": job_id,
+                "status": job["status"],
+                "offset": offset,
+                "limit": limit,
+                "processed": job["processed"],
+                "results": results,
+            },
+        )
+
+    def send_busy(self):
+        self.send_response(503)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Retry-After", str(BUSY_RETRY_AFTER))
+        self.end_headers()
+        message = "Servidor ocupado: limite de jobs simultaneos atingido."
+        self.wfile.write(json.dumps({"error": message}).encode("utf-8"))
+
+    def run_inline(self, slots, func, *args):
+        if not slots.acquire(blocking=False):
+            self.send_busy()
+            return
+        try:
+            func(*args)
+        finally:
+            slots.release()
+
+    def respond(self, data, error_msg):
+        if error_msg:
+            self.send_json(400, {"error": error_msg})
+            return
+        self.send_json(200, data)
+
+    def parse_options(self, options):
+        # Returns the import args, or sends a 400 and returns None when an
+        # option has a bad value (e.g. workers="abc").
+        try:
+            return build_args(options)
+        except (AttributeError, TypeError, ValueError) as exc:
+            self.send_json(400, {"error": f"Invalid options: {exc}"})
+            return None
+
+    def enqueue(self, options, write_input):
+        if self.parse_options(options) is None:
+            return
+        job = self.jobs.submit(options, write_input)
+        job_id = job["id"]
+        job["links"] = {
+            "status": f"/jobs/{job_id}",
+            "results": f"/jobs/{job_id}/results",
+        }
+        self.send_json(202, job)
+
+    def handle_post(self):
+        url = parse.urlsplit(self.path)
+        if url.path not in ("/run", "/list"):
             self.send_error(404, "Not Found")
             return
 
-        length = int(self.headers.get("Content-Length", "0"))
-        raw = self.rfile.read(length)
+        content_type = self.headers.get("Content-Type", "").split(";")[0].strip()
+        if url.path == "/run" and content_type == "text/csv":
+            self.run_upload(self.upload_options(url.query))
+            return
+
+        raw = self.request_body().read()
         try:
             payload = json.loads(raw.decode("utf-8"))
-        except json.JSONDecodeError:
+        except (UnicodeDecodeError, json.JSONDecodeError):
             self.send_error(400, "Invalid JSON")
             return
 
-        args = build_args(payload)
+        if url.path == "/list":
+            args = self.parse_options(payload)
+            if args is not None:
+                self.run_inline(
+                    self.list_slots,
+                    lambda: self.respond(*process_list(payload, args)),
+                )
+            return
 
-        if self.path == "/run":
-            csv_text = payload.get("csv", "")
-            if not csv_text.strip():
-                self.send_response(400)
-                self.send_header("Content-Type", "application/json")
-                self.end_headers()
-                self.wfile.write(json.dumps({"error": "CSV vazio."}).encode("utf-8"))
-                return
+        csv_text = payload.get("csv", "")
+        if not csv_text.strip():
+            self.send_json(400, {"error": "CSV vazio."})
+            return
+
+        options = {key: value for key, value in payload.items() if key != "csv"}
+        options.update(self.upload_options(url.query))
+        self.run_text(options, csv_text)
+
+    def run_upload(self, options):
+        # Raw CSV upload. Inline modes parse and dispatch rows while the body
+        # is still streaming in; queued jobs spool it to disk chunk by chunk.
+        body = self.request_body()
+        mode = self.stream_mode(options)
+        if not mode and not parse_bool(options.get("wait")):
+
+            def spool(path):
+                with open(path, "wb") as handle:
+                    for chunk in iter(lambda: body.read(SPOOL_CHUNK_SIZE), b""):
+                        handle.write(chunk)
 
-            data, error_msg = process_csv(csv_text, args)
+            self.enqueue(options, spool)
+            return
+
+        args = self.parse_options(options)
+        if args is None:
+            return
+        stream = io.TextIOWrapper(
+            io.BufferedReader(body),
+            encoding="utf-8-sig",
+            newline="",
+        )
+        if mode:
+
+            def fraction(processed):
+                return body.consumed / body.length
+
+            progress = fraction if body.length else None
+            self.run_inline(
+                self.job_slots, self.stream_csv, mode, stream, args, progress
+            )
         else:
-            data, error_msg = process_list(payload, args)
+            self.run_inline(
+                self.job_slots, lambda: self.respond(*process_csv(stream, args))
+            )
 
-        if error_msg:
-            self.send_response(400)
-            self.send_header("Content-Type", "application/json")
-            self.end_headers()
-            self.wfile.write(json.dumps({"error": error_msg}).encode("utf-8"))
+    def run_text(self, options, csv_text):
+        mode = self.stream_mode(options)
+        if not mode and not parse_bool(options.get("wait")):
+
+            def spool(path):
+                with open(path, "w", encoding="utf-8", newline="") as handle:
+                    handle.write(csv_text)
+
+            self.enqueue(options, spool)
             return
 
-        response = json.dumps(data, ensure_ascii=False).encode("utf-8")
-        self.send_response(200)
-        self.send_header("Content-Type", "application/json; charset=utf-8")
-        self.send_header("Content-Length", str(len(response)))
-        self.end_headers()
-        self.wfile.write(response)
+        args = self.parse_options(options)
+        if args is None:
+            return
+        if mode:
+            total = max(1, csv_text.rstrip("\n").count("\n"))
+
+            def progress(processed):
+                return min(1.0, processed / total)
+
+            self.run_inline(
+                self.job_slots, self.stream_csv, mode, csv_text, args, progress
+            )
+        else:
+            self.run_inline(
+                self.job_slots, lambda: self.respond(*process_csv(csv_text, args))
+            )
 
     def log_message(self, fmt, *args):
         return
 
 
+def parse_args():
+    parser = argparse.ArgumentParser(description="Web UI for bulk user creation.")
+    parser.add_argument("--host", default=HOST_DEFAULT, help="Bind address")
+    parser.add_argument("--port", type=int, default=PORT_DEFAULT, help="Port")
+    parser.add_argument(
+        "--max-jobs",
+        type=int,
+        default=MAX_JOBS_DEFAULT,
+        help="Max imports (/run) running at the same time",
+    )
+    parser.add_argument(
+        "--max-lists",
+        type=int,
+        default=MAX_LISTS_DEFAULT,
+        help="Max /list calls running at the same time",
+    )
+    parser.add_argument(
+        "--jobs-dir",
+        default=str(JOBS_DIR_DEFAULT),
+        help="Directory for queued job input, status and results",
+    )
+    parser.add_argument(
+        "--max-rps",
+        type=float,
+        default=cu.MAX_RPS_DEFAULT,
+        help="Requests-per-second ceiling shared by all jobs (0 disables)",
+    )
+    parser.add_argument(
+        "--scope-outcomes",
+        default=str(cu.SCOPE_OUTCOMES_PATH),
+        help="File that remembers templates whose scopes the API rejects",
+    )
+    return parser.parse_args()
+
+
 def main():
-    server = HTTPServer(("127.0.0.1", 8080), Handler)
-    print("Server running at http://127.0.0.1:8080")
+    args = parse_args()
+    Handler.job_slots = threading.BoundedSemaphore(max(1, args.max_jobs))
+    Handler.list_slots = threading.BoundedSemaphore(max(1, args.max_lists))
+    Handler.jobs = JobQueue(args.jobs_dir, args.max_jobs, Handler.job_slots)
+    metrics.JOB_QUEUE_DEPTH.func = Handler.jobs.queue_depth
+    cu.RATE_LIMITER.configure(args.max_rps)
+    cu.SCOPE_OUTCOMES.configure(args.scope_outcomes)
+    # Each request runs in its own thread, so GET / and /list stay responsive
+    # while an import is running.
+    server = ThreadingHTTPServer((args.host, args.port), Handler)
+    print(f"Server running at http://{args.host}:{args.port}")
     server.serve_forever()
 
 